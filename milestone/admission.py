@@ -0,0 +1,94 @@
+# admission.py
+"""
+Admission control for the pyhtml servers: requests the server cannot serve in
+good time are turned away at once (503 or 429 with Retry-After) instead of
+queueing until every client times out.
+
+    ConcurrencyLimiter   page renders in flight, overall and per route
+    RateLimiter          a token bucket per client
+
+Limits are passed in on every call (pyhtml reads them from its settings), so
+changing a setting takes effect without rebuilding anything. Rejections are
+counted by reason and exported on /metrics:
+
+    queue_full      the threaded server's accept queue was full
+    queue_timeout   a connection or page waited too long for a worker
+    concurrency     a route (or all pages) already had its limit of renders
+    rate            the client had used up its token bucket
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+REASONS = ("queue_full", "queue_timeout", "concurrency", "rate")
+
+_rejections = dict.fromkeys(REASONS, 0)
+_rejections_lock = threading.Lock()
+
+def rejected(reason):
+    """Count one request turned away for reason (one of REASONS)."""
+    with _rejections_lock:
+        _rejections[reason] += 1
+
+class ConcurrencyLimiter:
+    """Counts requests in flight, overall and per route, and refuses any beyond a limit."""
+    def __init__(self):
+        self.active = 0
+        self.by_route = {}
+        self.lock = threading.Lock()
+
+    def try_acquire(self, route, total=None, route_limit=None):
+        """Take a slot for route unless total or route_limit (None: unlimited) is reached."""
+        with self.lock:
+            in_route = self.by_route.get(route, 0)
+            if (total is not None and self.active >= total) or (route_limit is not None and in_route >= route_limit):
+                return False
+            self.active += 1
+            self.by_route[route] = in_route + 1
+            return True
+
+    def release(self, route):
+        with self.lock:
+            self.active -= 1
+            self.by_route[route] -= 1
+
+class RateLimiter:
+    """
+    Token bucket per client: `rate` tokens a second, at most `burst` saved up, one
+    per request. The least recently seen clients are forgotten beyond max_clients.
+    """
+    def __init__(self, max_clients=10000):
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()   # client -> (tokens, time of last update)
+        self.lock = threading.Lock()
+
+    def acquire(self, client, rate, burst, now=None):
+        """Take a token for client: 0.0 if there was one, else seconds until there will be."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, last = self.buckets.pop(client, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return wait
+
+pages = ConcurrencyLimiter()
+clients = RateLimiter()
+
+def admission_metrics():
+    lines = ["# TYPE pyhtml_admission_rejections_total counter"]
+    with _rejections_lock:
+        lines += [f'pyhtml_admission_rejections_total{{reason="{reason}"}} {count}'
+                  for reason, count in _rejections.items()]
+    lines += ["# TYPE pyhtml_pages_in_flight gauge", f"pyhtml_pages_in_flight {pages.active}"]
+    return lines
+
+metrics.collectors.append(admission_metrics)
@@ -0,0 +1,404 @@
+# analytics.py
+"""
+Vaccination coverage against disease incidence, for every country and year.
+
+Vaccination, InfectionData and CountryPopulation are loaded once into dense
+matrices aligned on (country, year): one row per country, one column per
+year, NaN where there is no value. From those, with whole-matrix operations
+(NumPy when installed, plain arrays otherwise, as in coverage_store):
+
+  - incidence: cases per 100,000 people, per disease
+  - rolling averages over a trailing window of years (missing years skipped)
+  - Pearson correlation of an antigen's coverage with its disease's incidence,
+    per year across countries and pooled over all country-years
+
+    engine = analytics.get_engine(DB_PATH)
+    result = engine.analyse("MCV1", window=3)
+
+The engine is rebuilt on first use after immunisation.db changes, and each
+(antigen, window) result is computed once per engine. The page below is
+registered as /analytics.
+"""
+import html
+import math
+import os
+import threading
+from array import array
+
+import pyhtml
+import refdata
+import templates
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; the array path gives the same results
+    np = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "database", "immunisation.db")
+
+PER_PEOPLE = 100_000    # incidence is reported per this many people
+DEFAULT_WINDOW = 3      # years in the rolling averages
+MAX_WINDOW = 10
+TOP_COUNTRIES = 10      # countries listed with the highest recent incidence
+
+NAN = math.nan
+
+COUNTRY_SQL = "SELECT CountryID, name FROM Country ORDER BY CountryID;"
+YEAR_SQL = "SELECT YearID FROM YearDate ORDER BY YearID;"
+DISEASE_SQL = "SELECT id, description FROM Infection_Type ORDER BY id;"
+POPULATION_SQL = "SELECT country, year, population FROM CountryPopulation WHERE population > 0;"
+CASES_SQL = "SELECT inf_type, country, year, cases FROM InfectionData WHERE cases IS NOT NULL;"
+COVERAGE_SQL = """
+    SELECT inf_type, antigen, country, year, coverage_pct
+    FROM Vaccination
+    WHERE coverage_pct IS NOT NULL
+"""
+
+# ---------- matrix operations (NumPy, or lists of array('d') rows) ----------
+def _matrix(rows, cols):
+    if np is not None:
+        return np.full((rows, cols), np.nan)
+    return [array("d", [NAN]) * cols for _ in range(rows)]
+
+def _per_people(cases, population):
+    """cases / population * PER_PEOPLE, element-wise (NaN where either is missing)."""
+    if np is not None:
+        return cases / population * PER_PEOPLE
+    return [array("d", [c / p * PER_PEOPLE for c, p in zip(crow, prow)])
+            for crow, prow in zip(cases, population)]
+
+def _rolling_mean(m, window):
+    """Mean over each cell's trailing `window` years, ignoring NaN (NaN if none in the window)."""
+    if window <= 1:
+        return m
+    if np is not None:
+        valid = ~np.isnan(m)
+        # Cumulative sums with a leading zero column: window sums are differences
+        sums = np.zeros((m.shape[0], m.shape[1] + 1))
+        counts = np.zeros_like(sums)
+        np.cumsum(np.where(valid, m, 0.0), axis=1, out=sums[:, 1:])
+        np.cumsum(valid, axis=1, out=counts[:, 1:])
+        lo = np.maximum(np.arange(1, m.shape[1] + 1) - window, 0)
+        total = sums[:, 1:] - sums[:, lo]
+        n = counts[:, 1:] - counts[:, lo]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(n > 0, total / n, np.nan)
+    out = []
+    for row in m:
+        means = array("d", [NAN]) * len(row)
+        total, n = 0.0, 0
+        for j, x in enumerate(row):
+            if x == x:
+                total += x
+                n += 1
+            if j >= window:
+                old = row[j - window]
+                if old == old:
+                    total -= old
+                    n -= 1
+            if n:
+                means[j] = total / n
+        out.append(means)
+    return out
+
+def _pearson(pairs):
+    """(r, n) for a list of (x, y); r is NaN for fewer than 3 pairs or no variance."""
+    n = len(pairs)
+    if n < 3:
+        return NAN, n
+    mx = sum(x for x, _ in pairs) / n
+    my = sum(y for _, y in pairs) / n
+    sxy = sum((x - mx) * (y - my) for x, y in pairs)
+    sxx = sum((x - mx) ** 2 for x, _ in pairs)
+    syy = sum((y - my) ** 2 for _, y in pairs)
+    if sxx == 0 or syy == 0:
+        return NAN, n
+    return sxy / math.sqrt(sxx * syy), n
+
+def _np_pearson(x, y, axis):
+    """Pearson r and pair counts along axis of x, y (cells where both are present)."""
+    both = ~(np.isnan(x) | np.isnan(y))
+    n = both.sum(axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mx = np.where(both, x, 0.0).sum(axis=axis, keepdims=True) / both.sum(axis=axis, keepdims=True)
+        my = np.where(both, y, 0.0).sum(axis=axis, keepdims=True) / both.sum(axis=axis, keepdims=True)
+        dx = np.where(both, x - mx, 0.0)
+        dy = np.where(both, y - my, 0.0)
+        sxx, syy = (dx * dx).sum(axis=axis), (dy * dy).sum(axis=axis)
+        r = (dx * dy).sum(axis=axis) / np.sqrt(sxx * syy)
+    r = np.where((n >= 3) & (sxx > 0) & (syy > 0), r, np.nan)
+    return r, n
+
+def _correlation_by_year(x, y):
+    """[(r, n)] per year column, across countries."""
+    if np is not None:
+        r, n = _np_pearson(x, y, axis=0)
+        return [(float(a), int(b)) for a, b in zip(r, n)]
+    return [_pearson([(a[j], b[j]) for a, b in zip(x, y) if a[j] == a[j] and b[j] == b[j]])
+            for j in range(len(x[0]) if x else 0)]
+
+def _correlation_pooled(x, y):
+    """(r, n) over every (country, year) cell."""
+    if np is not None:
+        r, n = _np_pearson(x.ravel(), y.ravel(), axis=0)
+        return float(r), int(n)
+    return _pearson([(a, b) for xrow, yrow in zip(x, y) for a, b in zip(xrow, yrow) if a == a and b == b])
+
+def _column_mean(m):
+    """Mean of each year column over the countries that have a value."""
+    if np is not None:
+        n = (~np.isnan(m)).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return [float(v) for v in np.where(n > 0, np.nansum(m, axis=0) / n, np.nan)]
+    means = []
+    for j in range(len(m[0]) if m else 0):
+        values = [row[j] for row in m if row[j] == row[j]]
+        means.append(sum(values) / len(values) if values else NAN)
+    return means
+
+def _column_rate(cases, population):
+    """Per year: total cases / total population * PER_PEOPLE over countries that have both."""
+    if np is not None:
+        both = ~(np.isnan(cases) | np.isnan(population))
+        c = np.where(both, cases, 0.0).sum(axis=0)
+        p = np.where(both, population, 0.0).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return [float(v) for v in np.where(p > 0, c / p * PER_PEOPLE, np.nan)]
+    rates = []
+    for j in range(len(cases[0]) if cases else 0):
+        c = p = 0.0
+        for crow, prow in zip(cases, population):
+            if crow[j] == crow[j] and prow[j] == prow[j]:
+                c += crow[j]
+                p += prow[j]
+        rates.append(c / p * PER_PEOPLE if p else NAN)
+    return rates
+
+def _column(m, j):
+    if np is not None:
+        return [float(v) for v in m[:, j]]
+    return [row[j] for row in m]
+
+# ---------- engine ----------
+class Analysis:
+    """Result of Engine.analyse() for one antigen and window."""
+    __slots__ = ("antigen", "disease", "window", "pooled", "pooled_rolling", "years", "latest_year", "top")
+    def __init__(self, antigen, disease, window, pooled, pooled_rolling, years, latest_year, top):
+        self.antigen = antigen
+        self.disease = disease
+        self.window = window
+        self.pooled = pooled                    # (r, n) coverage vs incidence, all country-years
+        self.pooled_rolling = pooled_rolling    # (r, n) of the rolling averages
+        self.years = years                      # [(year, n, r, mean coverage, rate, rolling rate)]
+        self.latest_year = latest_year          # last year with any incidence
+        self.top = top                          # [(country, rolling incidence, rolling coverage)] then
+
+class Engine:
+    def __init__(self, countries, years, diseases, population, cases, coverage):
+        # countries: [(CountryID, name)]; years: [year]; diseases: {inf_type: description}
+        self.country_ids = [cid for cid, _ in countries]
+        self.country_names = [name for _, name in countries]
+        self.years = list(years)
+        self.diseases = diseases
+        row = {cid: i for i, cid in enumerate(self.country_ids)}
+        col = {year: j for j, year in enumerate(self.years)}
+        shape = (len(self.country_ids), len(self.years))
+
+        def fill(m, country, year, value):
+            i, j = row.get(country), col.get(year)
+            if i is not None and j is not None:
+                m[i][j] = value
+
+        self.population = _matrix(*shape)
+        for country, year, people in population:
+            fill(self.population, country, year, people)
+
+        self.cases = {}         # inf_type -> cases matrix
+        for inf_type, country, year, n in cases:
+            if inf_type not in self.cases:
+                self.cases[inf_type] = _matrix(*shape)
+            fill(self.cases[inf_type], country, year, n)
+
+        self.coverage = {}      # antigen ID -> coverage matrix
+        self.antigen_disease = {}
+        for inf_type, antigen, country, year, pct in coverage:
+            if antigen not in self.coverage:
+                self.coverage[antigen] = _matrix(*shape)
+                self.antigen_disease[antigen] = inf_type
+            fill(self.coverage[antigen], country, year, pct)
+
+        # Incidence per disease, computed once for every window and antigen
+        self.incidence = {inf_type: _per_people(m, self.population) for inf_type, m in self.cases.items()}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, db_path):
+        def rows(sql):
+            return pyhtml.iter_rows(db_path, sql, named=False)
+        return cls(list(rows(COUNTRY_SQL)), [y for y, in rows(YEAR_SQL)], dict(rows(DISEASE_SQL)),
+                   rows(POPULATION_SQL), rows(CASES_SQL), rows(COVERAGE_SQL))
+
+    def analyse(self, antigen, window=DEFAULT_WINDOW):
+        """Analysis for an antigen ID (None if it has no coverage or its disease no cases)."""
+        key = (antigen, window)
+        result = self._results.get(key)
+        if result is None and key not in self._results:
+            with self._lock:
+                if key not in self._results:
+                    self._results[key] = self._analyse(antigen, window)
+            result = self._results[key]
+        return result
+
+    def _analyse(self, antigen, window):
+        inf_type = self.antigen_disease.get(antigen)
+        if inf_type not in self.incidence:
+            return None
+        coverage, incidence = self.coverage[antigen], self.incidence[inf_type]
+        rolling_coverage = _rolling_mean(coverage, window)
+        rolling_incidence = _rolling_mean(incidence, window)
+
+        by_year = _correlation_by_year(coverage, incidence)
+        mean_coverage = _column_mean(coverage)
+        rate = _column_rate(self.cases[inf_type], self.population)
+        rolling_rate = _rolling_mean(_matrix_row(rate), window)[0]
+
+        years = []
+        for j, year in enumerate(self.years):
+            r, n = by_year[j]
+            years.append((year, n, r, mean_coverage[j], rate[j], rolling_rate[j]))
+
+        # Countries with the highest rolling incidence in the latest year that has any
+        latest = max((j for j, value in enumerate(rate) if value == value), default=None)
+        top = []
+        if latest is not None:
+            recent = _column(rolling_incidence, latest)
+            cover = _column(rolling_coverage, latest)
+            ranked = sorted((i for i, v in enumerate(recent) if v == v), key=lambda i: -recent[i])
+            top = [(self.country_names[i], recent[i], cover[i]) for i in ranked[:TOP_COUNTRIES]]
+
+        return Analysis(antigen, self.diseases.get(inf_type, inf_type), window,
+                        _correlation_pooled(coverage, incidence),
+                        _correlation_pooled(rolling_coverage, rolling_incidence),
+                        years, self.years[latest] if latest is not None else None, top)
+
+def _matrix_row(values):
+    """A one-row matrix holding values."""
+    if np is not None:
+        return np.array([values], dtype=float)
+    return [array("d", values)]
+
+# ---------- shared instance, rebuilt when the database changes ----------
+def get_engine(db_path):
+    """The shared Engine for db_path, current with the database."""
+    return pyhtml.versioned_singleton(db_path, Engine.load)
+
+# ---------- page (/analytics) ----------
+PAGE = templates.Template("""<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>Coverage vs Incidence</title>
+  <link rel="stylesheet" href="{{stylesheet}}">
+</head>
+<body class="theme-cyan analytics">
+  <header>
+    <h1>📉 Vaccination Coverage vs Disease Incidence</h1>
+    <small>{{disease}} cases per 100,000 people against {{antigen}} coverage</small>
+  </header>
+
+  <form action="/analytics" method="GET" class="filters">
+    <label>Antigen
+      <select name="antigen">
+        {{antigen_options}}
+      </select>
+    </label>
+    <label>Rolling window (years)
+      <input type="number" name="window" min="1" max="{{max_window}}" value="{{window}}">
+    </label>
+    <button type="submit">Apply</button>
+    <a href="/analytics">Reset</a>
+  </form>
+
+  {{summary}}
+
+  <h3>By year (correlation across countries)</h3>
+  <table>
+    <thead>
+      <tr><th>Year</th><th>Countries</th><th>Correlation r</th><th>Mean coverage %</th>
+          <th>Incidence /100k</th><th>{{window}}-year average /100k</th></tr>
+    </thead>
+    <tbody>
+      {{year_rows}}
+    </tbody>
+  </table>
+
+  <h3>Highest {{window}}-year average incidence in {{latest_year}}</h3>
+  <table>
+    <thead>
+      <tr><th>Country</th><th>Incidence /100k</th><th>Coverage %</th></tr>
+    </thead>
+    <tbody>
+      {{top_rows}}
+    </tbody>
+  </table>
+
+  <div class="footer">
+    <a href="/">← Back to Level 1A</a>
+    <a href="/page2">→ Level 2A</a>
+    <a href="/page3">→ Level 3A</a>
+  </div>
+</body>
+</html>""")
+
+def fmt(value, digits=1):
+    return "—" if value is None or value != value else f"{value:,.{digits}f}"
+
+def fmt_r(r_n):
+    r, n = r_n
+    return f"{fmt(r, 3)} (n = {n:,})"
+
+get_first = pyhtml.get_first
+
+def get_page_html(form_data):
+    """
+    Coverage vs incidence for one antigen (by name; default the first) and rolling window.
+    Everything is computed from the in-memory engine; no queries unless the data changed.
+    """
+    ref = refdata.get_refdata(DB_PATH)
+    antigen = get_first(form_data, "antigen")
+    if antigen not in ref.antigen_ids:
+        antigen = ref.antigen_names[0] if ref.antigen_names else None
+    try:
+        window = min(max(int(get_first(form_data, "window") or DEFAULT_WINDOW), 1), MAX_WINDOW)
+    except ValueError:
+        window = DEFAULT_WINDOW
+
+    result = get_engine(DB_PATH).analyse(ref.antigen_ids.get(antigen), window) if antigen else None
+    if result is None:
+        summary = "<div class='warn'>No coverage or case data for this antigen.</div>"
+        year_rows = top_rows = ""
+    else:
+        summary = (f"<div class='filters'>Coverage vs incidence, all country-years: r = {fmt_r(result.pooled)}"
+                   f" &nbsp;·&nbsp; {window}-year averages: r = {fmt_r(result.pooled_rolling)}</div>")
+        year_rows = "".join(
+            f"<tr><td>{year}</td><td>{n}</td><td>{fmt(r, 3)}</td><td>{fmt(cov)}</td>"
+            f"<td>{fmt(rate, 2)}</td><td>{fmt(rolling, 2)}</td></tr>"
+            for year, n, r, cov, rate, rolling in result.years)
+        top_rows = "".join(
+            f"<tr><td>{html.escape(country)}</td><td>{fmt(rate, 2)}</td><td>{fmt(cov)}</td></tr>"
+            for country, rate, cov in result.top)
+
+    return PAGE.render(
+        stylesheet=templates.static_url("css/site.css"),
+        disease=html.escape(result.disease) if result else "",
+        antigen=html.escape(antigen or ""),
+        antigen_options=ref.antigen_options.render(antigen),
+        max_window=MAX_WINDOW,
+        window=window,
+        summary=summary,
+        year_rows=year_rows or "<tr><td colspan='6'>No data</td></tr>",
+        latest_year=result.latest_year if result and result.latest_year else "",
+        top_rows=top_rows or "<tr><td colspan='3'>No data</td></tr>",
+    )
@@ -0,0 +1,157 @@
+# api.py
+"""
+JSON and CSV versions of the datasets shown on the Level 2A and 3A pages,
+plus full exports of the fact tables, for dashboards that would otherwise
+scrape the HTML tables.
+
+    /api/countries.json    Level 2A table 1: countries meeting the >=90% target
+    /api/regions.json      Level 2A table 2: per-region counts meeting >=90%
+    /api/improvements.json Level 3A: largest coverage increases
+    /api/vaccination.json  Vaccination rows (export)
+    /api/infections.json   InfectionData rows (export)
+
+Every route also exists with .csv. They take the pages' parameters: antigen,
+year and region (Level 2A and the exports; the names shown in the dropdowns),
+start_year, end_year and top_n (Level 3A). Unknown filter values give an
+empty result, as on the pages.
+
+Rows are streamed a batch at a time as they come off the cursor
+(pyhtml.iter_batches), so a full export runs in constant memory and the
+first bytes go out before the query has finished. The exports are never
+kept in the response cache (which would hold every chunk of them); the
+page datasets are cached like the pages themselves. JSON is an array of
+objects keyed by column name; CSV has a header row.
+
+Register them with the other pages:
+    for route, endpoint in api.ROUTES.items():
+        pyhtml.MyRequestHandler.pages[route] = endpoint
+"""
+import csv
+import io
+import json
+
+import pyhtml
+import refdata
+import student_a_level_2 as level2
+import student_a_level_3 as level3
+
+DB_PATH = level2.DB_PATH
+
+get_first = level2.get_first
+
+def iter_batches(sql, params=()):
+    # Plain tuples: the encoders pair them with the column names themselves
+    return pyhtml.iter_batches(DB_PATH, sql, params, named=False)
+
+# ---------- datasets: form_data -> (columns, iterator of row batches) ----------
+def countries(form_data):
+    antigen, year, region = (get_first(form_data, k) for k in ("antigen", "year", "region"))
+    batches = iter_batches(*level2.countries_query(antigen, year, region))
+    return ("antigen", "year", "country", "region", "percentage_of_target"), batches
+
+def regions(form_data):
+    antigen, year, region = (get_first(form_data, k) for k in ("antigen", "year", "region"))
+    # Pre-aggregated (see cube.py): one batch
+    rows = level2.region_counts(antigen, year, region)
+    return ("antigen", "year", "region", "countries_met_90"), [rows] if rows else ()
+
+def improvements(form_data):
+    # Same defaults as the page: the full year range, top 10
+    years = refdata.get_refdata(DB_PATH).years
+    start_year = level3.get_first(form_data, "start_year", int)
+    end_year = level3.get_first(form_data, "end_year", int)
+    top_n = level3.get_first(form_data, "top_n", int)
+    if start_year is None and years:
+        start_year = years[0]
+    if end_year is None and years:
+        end_year = years[-1]
+    columns = ("country", "antigen", "rate_increase", "start_year", "end_year")
+    if start_year is None or end_year is None or start_year > end_year:
+        return columns, ()
+    limit = top_n if top_n and top_n > 0 else 10
+    # At most top_n rows, from the coverage store like the page: one batch
+    rows = level3.top_improvements(start_year, end_year, get_first(form_data, "antigen"), limit)
+    return columns, [rows] if rows else ()
+
+def export_filter(form_data, antigen_column=True):
+    """WHERE clause for the raw table exports (names resolved to IDs via refdata) -> (sql, params)."""
+    ref = refdata.get_refdata(DB_PATH)
+    antigen, year, region = (get_first(form_data, k) for k in ("antigen", "year", "region"))
+    where, params = [], []
+    if antigen and antigen_column:
+        where.append("antigen = ?")
+        params.append(ref.antigen_ids.get(antigen.strip()))
+    if year:
+        where.append("year = ?")
+        params.append(year.strip())
+    if region:
+        where.append("country IN (SELECT CountryID FROM Country WHERE region = ?)")
+        params.append(ref.region_ids.get(region.strip()))
+    return (" WHERE " + " AND ".join(where) if where else ""), tuple(params)
+
+def vaccination(form_data):
+    where, params = export_filter(form_data)
+    columns = ("inf_type", "antigen", "country", "year", "target_num", "doses", "coverage")
+    sql = f"SELECT {', '.join(columns)} FROM Vaccination{where} ORDER BY inf_type, antigen, country, year"
+    return columns, iter_batches(sql, params)
+
+def infections(form_data):
+    where, params = export_filter(form_data, antigen_column=False)
+    columns = ("inf_type", "country", "year", "cases")
+    sql = f"SELECT {', '.join(columns)} FROM InfectionData{where} ORDER BY inf_type, country, year"
+    return columns, iter_batches(sql, params)
+
+# ---------- encoders: (columns, batches) -> generator of str chunks, one per batch ----------
+def json_chunks(columns, batches):
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    sep = "\n"
+    yield "["
+    for batch in batches:
+        parts = []
+        for row in batch:
+            parts.append(sep + dumps(dict(zip(columns, row))))
+            sep = ",\n"
+        yield "".join(parts)
+    yield "\n]\n"
+
+def csv_chunks(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only (no rows)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+class Endpoint:
+    """A dataset in one format, registered in pyhtml.MyRequestHandler.pages like a page module."""
+    DB_PATH = DB_PATH   # cached responses are dropped when the database changes
+    def __init__(self, dataset, encoder, content_type, cacheable=True):
+        self.dataset = dataset
+        self.encoder = encoder
+        self.content_type = content_type
+        self.cacheable = cacheable
+
+    def get_page_html(self, form_data):
+        return self.encoder(*self.dataset(form_data))
+
+FORMATS = {
+    "json": (json_chunks, "application/json; charset=utf-8"),
+    "csv": (csv_chunks, "text/csv; charset=utf-8"),
+}
+DATASETS = {
+    "countries": countries,
+    "regions": regions,
+    "improvements": improvements,
+    "vaccination": vaccination,
+    "infections": infections,
+}
+# Whole fact tables: streamed, never cached
+EXPORTS = {"vaccination", "infections"}
+ROUTES = {f"/api/{name}.{ext}": Endpoint(dataset, encoder, content_type, cacheable=name not in EXPORTS)
+          for name, dataset in DATASETS.items()
+          for ext, (encoder, content_type) in FORMATS.items()}
@@ -0,0 +1,357 @@
+# async_server.py
+"""
+asyncio front end for pyhtml: the same MyRequestHandler.pages registry and the
+same responses (pyhtml.build_page_response), but connections are handled by
+one event loop and only rendering and SQLite work runs on a thread pool.
+
+    pyhtml.host_site(port=8080, server="asyncio")
+
+A connection costs a coroutine, not a worker thread, so thousands of idle or
+slow keep-alive clients no longer tie up the pool. At most `workers` pages
+are rendered at once; further requests wait on the event loop.
+
+A streamed page is produced inside a single executor job (its pooled SQLite
+connection and timing dict belong to that thread) and handed to the
+connection through a ChunkChannel holding at most STREAM_QUEUE_SIZE chunks,
+so a slow reader pauses the producer instead of the page piling up in memory.
+"""
+import asyncio
+import email.utils
+import http.client
+import io
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+import admission
+import metrics
+import pyhtml
+
+HEADER_TIMEOUT = 10       # seconds to receive a complete request head
+WRITE_TIMEOUT = 30        # seconds a client may take to accept more of a response
+SHUTDOWN_TIMEOUT = 10     # seconds in-flight requests get to finish on shutdown
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024   # request bodies are read and ignored, up to this size
+STREAM_QUEUE_SIZE = 4     # streamed chunks buffered between the producer and the socket
+SENDFILE_CHUNK_SIZE = 1024 * 1024   # large static files are sent in pieces of this size
+
+class ClientGone(Exception):
+    """The connection went away (or timed out) while a page was being streamed to it."""
+
+class ChunkChannel:
+    """Hands chunks from an executor thread to the event loop, at most `size` in flight."""
+    def __init__(self, loop, size=STREAM_QUEUE_SIZE):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.credits = threading.Semaphore(size)
+        self.closed = False
+
+    def put(self, kind, value=None):
+        """Called by the producer thread; blocks while the client is behind."""
+        if not self.credits.acquire(timeout=WRITE_TIMEOUT) or self.closed:
+            raise ClientGone()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (kind, value))
+
+    async def get(self):
+        item = await self.queue.get()
+        self.credits.release()
+        return item
+
+    def close(self):
+        """Called on the loop when the client is gone: wakes a blocked producer."""
+        self.closed = True
+        self.credits.release()
+
+class AsyncServer:
+    def __init__(self, port, workers=pyhtml.DEFAULT_WORKERS, directory=None):
+        self.port = port
+        self.workers = max(1, int(workers))
+        self.directory = directory or os.getcwd()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pyhtml-async")
+        self.connections = {}   # task -> True while a request is being served
+        self.closing = False
+
+    async def serve(self, sock=None, on_ready=None, signals=(signal.SIGINT, signal.SIGTERM)):
+        """Serve until one of signals arrives; sock is an already listening socket to use."""
+        self.jobs = asyncio.Semaphore(self.workers)
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in signals:
+            try:
+                loop.add_signal_handler(signum, self.stopping.set)
+            except (NotImplementedError, RuntimeError):  # not on Windows / not the main thread
+                pass
+        if sock is not None:
+            server = await asyncio.start_server(self.handle_connection, sock=sock, limit=MAX_HEADER_BYTES)
+        else:
+            server = await asyncio.start_server(self.handle_connection, port=self.port, reuse_address=True,
+                                                backlog=128, limit=MAX_HEADER_BYTES)
+        if on_ready is not None:
+            on_ready()
+        async with server:
+            await self.stopping.wait()
+            await self.shutdown(server)
+
+    async def shutdown(self, server):
+        """Stop accepting, let in-flight requests finish (up to SHUTDOWN_TIMEOUT), close the rest."""
+        pyhtml.logger.info("shutting down: %d open connection(s)", len(self.connections))
+        server.close()
+        self.closing = True
+        for task, busy in list(self.connections.items()):
+            if not busy:
+                task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=SHUTDOWN_TIMEOUT)
+        for task in list(self.connections):
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # ---------- connections ----------
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = False
+        peer = writer.get_extra_info("peername")
+        client_host = peer[0] if peer else ""
+        try:
+            timeout = HEADER_TIMEOUT
+            while not self.closing:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.send_simple(writer, pyhtml.error_response(431, "Request header fields too large"))
+                    break
+                self.connections[task] = True
+                keep_alive = await self.handle_request(head, reader, writer, client_host)
+                self.connections[task] = False
+                if not keep_alive:
+                    break
+                timeout = pyhtml.KEEP_ALIVE_TIMEOUT
+        except (ConnectionError, EOFError, ClientGone, asyncio.TimeoutError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+    async def handle_request(self, head, reader, writer, client_host):
+        """Serve one request; returns whether the connection may be kept alive."""
+        started = time.perf_counter()
+        request_line, _, header_block = head.partition(b"\r\n")
+        try:
+            method, target, version = request_line.decode("iso-8859-1").split()
+            headers = http.client.parse_headers(io.BytesIO(header_block))
+        except (ValueError, http.client.HTTPException):
+            await self.send_simple(writer, pyhtml.error_response(400, "Bad request"))
+            return False
+
+        keep_alive = version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        length = headers.get("Content-Length")
+        if length:
+            if not length.isdigit() or int(length) > MAX_BODY_BYTES:
+                await self.send_simple(writer, pyhtml.error_response(413, "Request body too large"))
+                return False
+            await asyncio.wait_for(reader.readexactly(int(length)), HEADER_TIMEOUT)
+
+        parsed_url = urlparse(target)
+        route = parsed_url.path if parsed_url.path in pyhtml.MyRequestHandler.pages else "static"
+        timing = {}
+        status, size = 500, 0
+        metrics.request_started(route)
+        try:
+            if method not in ("GET", "HEAD"):
+                status, size = await self.send_simple(writer, pyhtml.error_response(501, "Unsupported method"))
+                keep_alive = False
+            elif route != "static":
+                form_data = parse_qs(parsed_url.query)
+                timing["parse"] = time.perf_counter() - started
+                status, size = await self.serve_page(route, form_data, headers, client_host, version,
+                                                     timing, writer, method == "HEAD", keep_alive)
+            else:
+                # Files kept in memory are answered here; anything that needs the disk goes to a worker.
+                response = pyhtml.cached_static_response(target, self.directory, headers)
+                if response is None:
+                    async with self.jobs:
+                        response = await asyncio.get_running_loop().run_in_executor(
+                            self.executor, pyhtml.static_response, target, self.directory, headers)
+                if isinstance(response, pyhtml.FileResponse):
+                    status, size = await self.send_file(writer, response, method == "HEAD", keep_alive)
+                else:
+                    status, size = await self.send_simple(writer, response, method == "HEAD", keep_alive)
+        finally:
+            metrics.request_finished(route, status, time.perf_counter() - started, timing)
+            pyhtml.access_logger.info('%s "%s" %s %s', client_host,
+                                      request_line.decode("iso-8859-1", "replace"), status, size or "-")
+        return keep_alive and not self.closing
+
+    # ---------- responses ----------
+    async def serve_page(self, route, form_data, headers, client_host, version, timing, writer, head_only,
+                         keep_alive):
+        # Cache hits are answered right here: handing them to a worker thread and back
+        # costs more (GIL hand-offs) than serving them.
+        response = pyhtml.cached_page_response(route, form_data, headers, client_host, timing)
+        if response is None:
+            # Admission control: a 429/503 now rather than a long wait
+            response = pyhtml.admit_page(route, form_data, client_host)
+        if response is not None:
+            writer.write(self.head(response, keep_alive))
+            if not head_only:
+                writer.write(response.body)
+            await self.drain(writer, timing)
+            return response.status, len(response.body)
+        try:
+            return await self.render_page(route, form_data, headers, client_host, version, timing, writer,
+                                          head_only, keep_alive)
+        finally:
+            pyhtml.finish_page(route)
+
+    async def render_page(self, route, form_data, headers, client_host, version, timing, writer, head_only,
+                          keep_alive):
+        try:
+            await asyncio.wait_for(self.jobs.acquire(), pyhtml.ACCEPT_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            admission.rejected("queue_timeout")
+            busy = pyhtml.overload_response(503, "Server busy", pyhtml.RETRY_AFTER)
+            return await self.send_simple(writer, busy, head_only, keep_alive)
+        loop = asyncio.get_running_loop()
+        channel = ChunkChannel(loop)
+        try:
+            job = loop.run_in_executor(self.executor, produce_page, channel, route, form_data, headers,
+                                       client_host, version == "HTTP/1.1", timing)
+            try:
+                kind, response = await channel.get()
+                if kind == "error":
+                    pyhtml.logger.error("page %s failed", route, exc_info=response)
+                    return await self.send_simple(writer, pyhtml.error_response(500, "Internal server error"),
+                                                 head_only, keep_alive)
+                writer.write(self.head(response, keep_alive))
+                if response.chunks is None:
+                    if not head_only:
+                        writer.write(response.body)
+                    await self.drain(writer, timing)
+                    return response.status, len(response.body)
+                await self.drain(writer)
+                size = 0
+                while True:
+                    kind, data = await channel.get()
+                    if kind == "end":
+                        break
+                    if kind == "error":
+                        # Headers are out already: all we can do is cut the connection.
+                        pyhtml.logger.error("page %s failed while streaming", route, exc_info=data)
+                        raise ClientGone()
+                    if not head_only:
+                        writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                        size += len(data)
+                        await self.drain(writer)
+                if not head_only:
+                    writer.write(b"0\r\n\r\n")
+                    await self.drain(writer)
+                return response.status, size
+            finally:
+                channel.close()
+                await asyncio.shield(job)
+        finally:
+            self.jobs.release()
+
+    async def send_simple(self, writer, response, head_only=False, keep_alive=False):
+        writer.write(self.head(response, keep_alive))
+        if not head_only:
+            writer.write(response.body)
+        await self.drain(writer)
+        return response.status, len(response.body)
+
+    async def send_file(self, writer, response, head_only, keep_alive):
+        """Send a FileResponse with loop.sendfile() (zero-copy where the transport allows it)."""
+        with response.file:
+            writer.write(self.head(response, keep_alive))
+            await self.drain(writer)
+            if head_only:
+                return response.status, 0
+            loop = asyncio.get_running_loop()
+            offset, end = response.offset, response.offset + response.count
+            while offset < end:
+                # In pieces, so a stalled client is cut off after WRITE_TIMEOUT like anywhere else
+                count = min(SENDFILE_CHUNK_SIZE, end - offset)
+                await asyncio.wait_for(loop.sendfile(writer.transport, response.file, offset, count),
+                                       WRITE_TIMEOUT)
+                offset += count
+        return response.status, response.count
+
+    def head(self, response, keep_alive):
+        lines = [f"HTTP/1.1 {response.status} {http.client.responses.get(response.status, '')}",
+                 f"Date: {http_date()}",
+                 "Server: pyhtml-asyncio"]
+        lines += [f"{name}: {value}" for name, value in response.headers]
+        if not keep_alive:
+            lines.append("Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+    async def drain(self, writer, timing=None):
+        """Wait (up to WRITE_TIMEOUT) until the client has taken most of what was written."""
+        t0 = time.perf_counter()
+        await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+        if timing is not None:
+            # Streamed pages are timed by the producer instead (see produce_page)
+            timing["write"] = timing.get("write", 0.0) + time.perf_counter() - t0
+
+def produce_page(channel, route, form_data, headers, client_host, chunked, timing):
+    """Executor job: build the response and push it (and any streamed chunks) into channel."""
+    pyhtml.set_request_timing(timing)
+    try:
+        response = pyhtml.build_page_response(route, form_data, headers, client_host, timing, chunked, lookup=False)
+        chunks = response.chunks
+        channel.put("head", response)
+        if chunks is not None:
+            for data in chunks:
+                t0 = time.perf_counter()
+                channel.put("data", data)
+                # Waiting for the client to take the data is this request's "write" time.
+                timing["write"] = timing.get("write", 0.0) + time.perf_counter() - t0
+            channel.put("end")
+    except ClientGone:
+        pass
+    except Exception as e:
+        try:
+            channel.put("error", e)
+        except (ClientGone, RuntimeError):
+            pass
+    finally:
+        pyhtml.set_request_timing(None)
+
+def serve(sock, workers=pyhtml.DEFAULT_WORKERS, on_ready=None):
+    """Run an AsyncServer on an inherited listening socket until SIGTERM (prefork workers)."""
+    server = AsyncServer(sock.getsockname()[1], workers)
+    asyncio.run(server.serve(sock=sock, on_ready=on_ready, signals=(signal.SIGTERM,)))
+
+_date_cache = [0, ""]
+
+def http_date():
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache[:] = [now, email.utils.formatdate(now, usegmt=True)]
+    return _date_cache[1]
+
+def host_site(port=80, workers=pyhtml.DEFAULT_WORKERS):
+    pyhtml.configure_logging()
+    server = AsyncServer(port, workers)
+    print("Using your favourite browser, go to:\n")
+    if port == 80:
+        print("http://localhost")
+    print(f"or\nhttp://localhost:{port}\n")
+    print(f"Serving with asyncio and {server.workers} worker thread(s)\n")
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pyhtml.stop_logging()
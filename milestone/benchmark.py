@@ -0,0 +1,339 @@
+# benchmark.py
+"""
+Benchmarks for the page modules and the pyhtml server.
+
+    python benchmark.py micro                  call every get_page_html in-process
+    python benchmark.py load                   drive a local server with concurrent clients
+    python benchmark.py all --save base.json   run both and save the results as a baseline
+    python benchmark.py all --compare base.json --threshold 0.2
+                                               exit 1 if any route is >20% worse than the baseline
+    python benchmark.py load --processes 4 --client-processes 4
+                                               prefork server with 4 processes, clients in 4 processes
+    python benchmark.py load --server asyncio --idle 500
+                                               load-test the asyncio server with 500 idle
+                                               keep-alive connections held open alongside
+
+Both layers report requests/s and p50/p95/p99 latency (ms) per route.
+The form_data matrix covers every antigen, year, region and start/end year
+combination; --sample N picks N random cases per route instead.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+import migrate_db
+import pyhtml
+import student_a_level_1
+import student_a_level_2
+import student_a_level_3
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = student_a_level_2.DB_PATH
+
+ROUTES = {
+    "/": student_a_level_1,
+    "/page2": student_a_level_2,
+    "/page3": student_a_level_3,
+}
+TOP_N_VALUES = (5, 10, 50)
+
+# ---------- form_data matrix ----------
+def form_matrix():
+    """route -> list of form_data dicts (parse_qs style) covering the filter combinations."""
+    antigens = [r[0] for r in pyhtml.get_results_from_query(DB_PATH, "SELECT name FROM Antigen ORDER BY name;")]
+    years = [r[0] for r in pyhtml.get_results_from_query(DB_PATH, "SELECT YearID FROM YearDate ORDER BY YearID;")]
+    regions = [r[0] for r in pyhtml.get_results_from_query(DB_PATH, "SELECT region FROM Region ORDER BY region;")]
+
+    def form(**values):
+        return {k: [str(v)] for k, v in values.items() if v is not None}
+
+    page2 = [form(antigen=a, year=y, region=r)
+             for a, y, r in itertools.product([None] + antigens, [None] + years, [None] + regions)]
+    page3 = [form(antigen=a, start_year=s, end_year=e, top_n=n)
+             for a, (s, e), n in itertools.product([None] + antigens,
+                                                   itertools.combinations_with_replacement(years, 2),
+                                                   TOP_N_VALUES)]
+    return {"/": [{}], "/page2": page2, "/page3": page3}
+
+def sample_matrix(matrix, sample, seed=0):
+    if not sample:
+        return matrix
+    rng = random.Random(seed)
+    return {route: forms if len(forms) <= sample else rng.sample(forms, sample)
+            for route, forms in matrix.items()}
+
+# ---------- statistics ----------
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(latencies, elapsed):
+    """latencies in seconds -> dict of count, rps and p50/p95/p99 in ms."""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "rps": len(values) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+# ---------- microbenchmarks ----------
+def render(page, form_data):
+    html = page.get_page_html(form_data)
+    if not isinstance(html, (str, bytes)):
+        for _ in html:  # drain generator pages
+            pass
+
+def run_micro(matrix, repeat=1):
+    results = {}
+    for route, forms in matrix.items():
+        page = ROUTES[route]
+        render(page, forms[0])  # warm up connections and in-memory stores
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for form_data in forms:
+                t0 = time.perf_counter()
+                render(page, form_data)
+                latencies.append(time.perf_counter() - t0)
+        results[route] = summarize(latencies, time.perf_counter() - started)
+    return results
+
+# ---------- load tests ----------
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(port, workers, cache, server="threads", processes=1, rate_limit=False):
+    """Start demo-style server in a subprocess (so it does not share our GIL)."""
+    cmd = [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port), "--workers", str(workers),
+           "--server", server, "--processes", str(processes)]
+    if not cache:
+        cmd.append("--no-cache")
+    if rate_limit:
+        cmd.append("--rate-limit")
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("benchmark server did not start")
+
+def client(port, urls, stop_at, latencies, errors, shed, seed):
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    headers = {"Accept-Encoding": "gzip"}
+    routes = list(urls)
+    while time.perf_counter() < stop_at:
+        # every route gets the same share of traffic, whatever its matrix size
+        route = rng.choice(routes)
+        url = rng.choice(urls[route])
+        t0 = time.perf_counter()
+        try:
+            conn.request("GET", url, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status in (429, 503):
+                # Turned away by admission control: not a latency sample, not an error.
+                # Back off as asked, like a well-behaved client, without holding a connection.
+                shed[route] = shed.get(route, 0) + 1
+                conn.close()
+                retry_after = float(response.getheader("Retry-After") or 1)
+                time.sleep(min(retry_after, max(0.0, stop_at - time.perf_counter())))
+                continue
+            if response.status >= 500:
+                errors[route] = errors.get(route, 0) + 1
+                continue
+        except (OSError, http.client.HTTPException):
+            errors[route] = errors.get(route, 0) + 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies.setdefault(route, []).append(time.perf_counter() - t0)
+    conn.close()
+
+def open_idle_connections(port, count):
+    """Connections that send nothing, like browsers holding a keep-alive connection open."""
+    idle = []
+    for _ in range(count):
+        try:
+            idle.append(socket.create_connection(("127.0.0.1", port), timeout=5))
+        except OSError:
+            break
+    return idle
+
+def client_group(port, urls, duration, clients, first_seed):
+    """Run `clients` client threads for duration seconds; returns their (latencies, errors, shed) dicts."""
+    per_client = [({}, {}, {}) for _ in range(clients)]
+    stop_at = time.perf_counter() + duration
+    threads = [threading.Thread(target=client, args=(port, urls, stop_at, lat, err, shed, first_seed + i))
+               for i, (lat, err, shed) in enumerate(per_client)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return per_client
+
+def run_load(matrix, clients=16, duration=10.0, workers=pyhtml.DEFAULT_WORKERS, cache=True, port=None,
+             server="threads", idle=0, processes=1, client_processes=1, rate_limit=False):
+    urls = {route: [route + ("?" + urlencode(form, doseq=True) if form else "") for form in forms]
+            for route, forms in matrix.items()}
+    own_server = port is None
+    if own_server:
+        port = free_port()
+        proc = start_server(port, workers, cache, server, processes, rate_limit)
+    idle_connections = open_idle_connections(port, idle)
+    try:
+        started = time.perf_counter()
+        if client_processes > 1:
+            # One client process is GIL-bound itself; split the clients over several.
+            groups = [clients // client_processes + (i < clients % client_processes)
+                      for i in range(client_processes)]
+            with multiprocessing.Pool(client_processes) as pool:
+                results = pool.starmap(client_group, [(port, urls, duration, n, sum(groups[:i]))
+                                                      for i, n in enumerate(groups)])
+            per_client = [c for group in results for c in group]
+        else:
+            per_client = client_group(port, urls, duration, clients, 0)
+        elapsed = time.perf_counter() - started
+    finally:
+        for conn in idle_connections:
+            conn.close()
+        if own_server:
+            proc.terminate()
+            proc.wait()
+
+    results = {}
+    for route in matrix:
+        latencies = [x for lat, _, _ in per_client for x in lat.get(route, [])]
+        results[route] = summarize(latencies, elapsed)
+        results[route]["errors"] = sum(err.get(route, 0) for _, err, _ in per_client)
+        results[route]["shed"] = sum(shed.get(route, 0) for _, _, shed in per_client)
+    all_latencies = [x for lat, _, _ in per_client for values in lat.values() for x in values]
+    results["*"] = summarize(all_latencies, elapsed)
+    results["*"]["errors"] = sum(results[route]["errors"] for route in matrix)
+    results["*"]["shed"] = sum(results[route]["shed"] for route in matrix)
+    return results
+
+# ---------- baselines ----------
+def compare(current, baseline, threshold):
+    """List of human-readable regressions worse than threshold (0.2 = 20%)."""
+    regressions = []
+    for layer in ("micro", "load"):
+        for route, stats in current.get(layer, {}).items():
+            base = baseline.get(layer, {}).get(route)
+            if not base:
+                continue
+            for metric in ("p50_ms", "p95_ms", "p99_ms"):
+                if base[metric] > 0 and stats[metric] > base[metric] * (1 + threshold):
+                    regressions.append(f"{layer} {route} {metric}: {base[metric]:.2f} -> {stats[metric]:.2f}")
+            if base["rps"] > 0 and stats["rps"] < base["rps"] * (1 - threshold):
+                regressions.append(f"{layer} {route} rps: {base['rps']:.1f} -> {stats['rps']:.1f}")
+    return regressions
+
+def print_table(title, results):
+    print(f"\n{title}")
+    print(f"  {'route':<8} {'count':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, s in results.items():
+        print(f"  {route:<8} {s['count']:>7} {s['rps']:>9.1f} {s['p50_ms']:>8.2f} {s['p95_ms']:>8.2f} {s['p99_ms']:>8.2f}")
+
+def serve(args):
+    """Internal: the server process started by the load test."""
+    for route, page in ROUTES.items():
+        pyhtml.MyRequestHandler.pages[route] = page
+    pyhtml.need_debugging_help = False
+    if args.no_cache:
+        pyhtml.response_cache.max_bytes = 0
+    if not args.rate_limit:
+        # All benchmark clients share one address: one token bucket would throttle them all
+        pyhtml.RATE_LIMIT = None
+    pyhtml.host_site(port=args.port, workers=args.workers, server=args.server, processes=args.processes)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the page modules and the pyhtml server.")
+    parser.add_argument("mode", choices=["micro", "load", "all", "serve"])
+    parser.add_argument("--sample", type=int, default=0, help="random form_data cases per route (0 = all)")
+    parser.add_argument("--repeat", type=int, default=1, help="micro: passes over the matrix")
+    parser.add_argument("--clients", type=int, default=16, help="load: concurrent keep-alive clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="load: seconds to run")
+    parser.add_argument("--workers", type=int, default=pyhtml.DEFAULT_WORKERS, help="server worker threads")
+    parser.add_argument("--port", type=int, help="load: use an already running server on this port")
+    parser.add_argument("--server", choices=["threads", "asyncio"], default="threads", help="load: server to start")
+    parser.add_argument("--idle", type=int, default=0, help="load: idle keep-alive connections held open meanwhile")
+    parser.add_argument("--processes", type=int, default=1, help="load: server processes (prefork when > 1)")
+    parser.add_argument("--client-processes", type=int, default=1, help="load: processes the clients run in")
+    parser.add_argument("--no-cache", action="store_true", help="disable the server's response cache")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="keep the server's per-client rate limit (429s are counted as shed)")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed regression (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    # Bring immunisation.db up to the schema the pages expect (no-op when already current)
+    migrate_db.migrate()
+
+    if args.mode == "serve":
+        return serve(args)
+
+    pyhtml.need_debugging_help = False
+    matrix = sample_matrix(form_matrix(), args.sample)
+    results = {"meta": {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "sample": args.sample,
+        "cases": {route: len(forms) for route, forms in matrix.items()},
+    }}
+    if args.mode in ("micro", "all"):
+        results["micro"] = run_micro(matrix, args.repeat)
+        print_table("Microbenchmarks (in-process get_page_html)", results["micro"])
+    if args.mode in ("load", "all"):
+        results["load"] = run_load(matrix, args.clients, args.duration, args.workers,
+                                   cache=not args.no_cache, port=args.port, server=args.server, idle=args.idle,
+                                   processes=args.processes, client_processes=args.client_processes,
+                                   rate_limit=args.rate_limit)
+        results["meta"].update(clients=args.clients, duration=args.duration, workers=args.workers,
+                               cache=not args.no_cache, server=args.server, idle=args.idle,
+                               processes=args.processes, client_processes=args.client_processes,
+                               rate_limit=args.rate_limit)
+        print_table(f"Load test ({args.clients} clients, {args.duration:.0f}s)", results["load"])
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegressions beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print("  " + line)
+            return 1
+        print(f"\nNo regressions beyond {args.threshold:.0%} against {args.compare}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+# coverage_store.py
+"""
+In-memory, array-backed copy of Vaccination coverage for Level 3.
+
+Coverage is held as one dense column per year, indexed by series, where a
+series is one (antigen, country) pair. Series are sorted by antigen, so each
+antigen is a contiguous slice. A (start, end) improvement is a subtraction of
+two columns, and top-N is a partial selection (argpartition, or heapq when
+NumPy is not installed), not a full sort.
+
+The store is rebuilt on first use after immunisation.db changes.
+"""
+import bisect
+import heapq
+import math
+from array import array
+
+import pyhtml
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; the array/heapq path gives the same results
+    np = None
+
+LOAD_SQL = """
+    SELECT A.name, C.name, V.year, V.coverage_pct
+    FROM Vaccination V
+    JOIN Antigen A ON A.AntigenID = V.antigen
+    JOIN Country C ON C.CountryID = V.country
+    WHERE V.coverage_pct IS NOT NULL
+"""
+
+class CoverageStore:
+    @classmethod
+    def load(cls, db_path):
+        return cls(pyhtml.get_results_from_query(db_path, LOAD_SQL))
+
+    def __init__(self, rows):
+        rows = list(rows)
+        self.series = sorted({(antigen, country) for antigen, country, _, _ in rows})
+        self.years = sorted({year for _, _, year, _ in rows})
+        series_index = {key: i for i, key in enumerate(self.series)}
+        self.year_index = {year: i for i, year in enumerate(self.years)}
+
+        # Contiguous [lo, hi) series range per antigen
+        self.antigen_slices = {}
+        for i, (antigen, _) in enumerate(self.series):
+            lo, _ = self.antigen_slices.get(antigen, (i, i))
+            self.antigen_slices[antigen] = (lo, i + 1)
+
+        # Tie-break rank matching SQL "ORDER BY rate_increase DESC, country, antigen"
+        by_country = sorted(range(len(self.series)), key=lambda i: (self.series[i][1], self.series[i][0]))
+        self.rank = [0] * len(self.series)
+        for r, i in enumerate(by_country):
+            self.rank[i] = r
+        self.names_by_rank = [(self.series[i][1], self.series[i][0]) for i in by_country]
+
+        n = len(self.series)
+        if np is not None:
+            self.matrix = np.full((len(self.years), n), np.nan)
+            self.rank_array = np.array(self.rank)
+            for antigen, country, year, coverage in rows:
+                self.matrix[self.year_index[year], series_index[(antigen, country)]] = coverage
+        else:
+            self.matrix = [array("d", [math.nan]) * n for _ in self.years]
+            for antigen, country, year, coverage in rows:
+                self.matrix[self.year_index[year]][series_index[(antigen, country)]] = coverage
+
+    def top_improvements(self, start_year, end_year, antigen=None, limit=10, after=None):
+        """
+        Rows (country, antigen, rate_increase, start_year, end_year) with the largest
+        end - start coverage increase, same order as student_a_level_3.improvement_query().
+        after = (rate_increase, country, antigen) of the last row of the previous page.
+        """
+        if start_year not in self.year_index or end_year not in self.year_index or limit <= 0:
+            return []
+        if antigen:
+            lo, hi = self.antigen_slices.get(antigen.strip(), (0, 0))
+        else:
+            lo, hi = 0, len(self.series)
+        s, e = self.year_index[start_year], self.year_index[end_year]
+        if after is not None:
+            # rows tied on rate come after `after` when their (country, antigen) rank is >= cut
+            after = (after[0], bisect.bisect_right(self.names_by_rank, (after[1], after[2])))
+
+        if np is not None:
+            picked = self._top_numpy(s, e, lo, hi, limit, after)
+        else:
+            picked = self._top_python(s, e, lo, hi, limit, after)
+        return [(self.series[i][1], self.series[i][0], rate, start_year, end_year) for i, rate in picked]
+
+    def _top_numpy(self, s, e, lo, hi, limit, after):
+        rates = np.round(self.matrix[e, lo:hi] - self.matrix[s, lo:hi], 2)
+        valid = np.flatnonzero(~np.isnan(rates))
+        values = rates[valid]
+        if after is not None:
+            rate, cut = after
+            keep = (values < rate) | ((values == rate) & (self.rank_array[valid + lo] >= cut))
+            valid, values = valid[keep], values[keep]
+        if valid.size == 0:
+            return []
+        if valid.size > limit:
+            # k-th largest value; keep everything >= it so ties at the cut are ordered properly
+            kth = values[np.argpartition(-values, limit - 1)[limit - 1]]
+            keep = values >= kth
+            valid, values = valid[keep], values[keep]
+        order = np.lexsort((self.rank_array[valid + lo], -values))[:limit]
+        return [(int(valid[i]) + lo, float(values[i])) for i in order]
+
+    def _top_python(self, s, e, lo, hi, limit, after):
+        start, end, rank = self.matrix[s], self.matrix[e], self.rank
+        candidates = []
+        for i in range(lo, hi):
+            rate = end[i] - start[i]
+            if rate == rate:  # skip NaN (missing in either year)
+                candidates.append((round(rate, 2), -rank[i], i))
+        if after is not None:
+            # (rate, -rank) sorts descending exactly like the page, so "after" is a plain comparison
+            bound = (after[0], -after[1] + 1)
+            candidates = [c for c in candidates if c[:2] < bound]
+        return [(i, rate) for rate, _, i in heapq.nlargest(limit, candidates)]
+
+
+# ---------- shared instance, rebuilt when the database changes ----------
+def get_store(db_path):
+    """The CoverageStore for db_path, reloaded when the database changes."""
+    return pyhtml.versioned_singleton(db_path, CoverageStore.load)
@@ -0,0 +1,369 @@
+# cube.py
+"""
+Vaccination coverage pre-aggregated over antigen x year x region x economy.
+
+Every cell, including the "All" rollups of each dimension (ALL), holds the
+coverage statistics of its country-year observations and, for each of
+THRESHOLDS, how many distinct countries reached it at least once, so any
+slice or drill-down is a dictionary lookup:
+
+    cube = cube.get_cube(DB_PATH)
+    cube.cell(antigen="MCV1", year=2004)            # region and economy: ALL
+    cube.cell(antigen="MCV1", year=2004).met[90]    # countries with coverage >= 90%
+    cube.group(("economy",), antigen="MCV1")        # one cell per economy phase
+
+Members are the IDs of the dimension tables (years are ints); None is a real
+member (countries without a region or economy), so ALL is a separate marker.
+Distinct countries do not add up across cells, so while the cube is built
+each cell keeps its countries as a bitmask (one bit per country): a rollup
+is an OR, a count is int.bit_count().
+
+Like coverage_store, the cube is rebuilt on first use after immunisation.db
+changes. Level 2A's Table 2 (and /api/regions) read from it, and the page
+below, registered as /drilldown, breaks any slice down by economy, region,
+antigen or year.
+"""
+import html
+import itertools
+import os
+from urllib.parse import urlencode
+
+import pyhtml
+import refdata
+import templates
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "database", "immunisation.db")
+
+DIMENSIONS = ("antigen", "year", "region", "economy")
+ALL = "*"                           # the rollup member of every dimension
+THRESHOLDS = (50, 80, 90, 95)       # coverage % levels counted per cell
+DEFAULT_THRESHOLD = 90
+
+FACT_SQL = """
+    SELECT V.antigen, V.year, R.RegionID, E.economyID, V.country, V.coverage_pct
+    FROM Vaccination V
+    JOIN Antigen A ON A.AntigenID = V.antigen
+    JOIN Country C ON C.CountryID = V.country
+    LEFT JOIN Region R ON R.RegionID = C.region
+    LEFT JOIN Economy E ON E.economyID = C.economy
+    WHERE V.coverage_pct IS NOT NULL
+"""
+ECONOMY_SQL = "SELECT economyID, phase FROM Economy ORDER BY economyID;"
+
+class Cell:
+    """Statistics of one cube cell; met maps each of THRESHOLDS to a number of countries."""
+    __slots__ = ("observations", "mean", "low", "high", "countries", "met")
+    def __init__(self, observations, mean, low, high, countries, met):
+        self.observations = observations
+        self.mean = mean
+        self.low = low
+        self.high = high
+        self.countries = countries
+        self.met = met
+
+# Accumulator layout while building: [observations, total, low, high, country mask, met masks...]
+def _new_acc():
+    return [0, 0.0, float("inf"), float("-inf"), 0] + [0] * len(THRESHOLDS)
+
+def _merge(acc, other):
+    acc[0] += other[0]
+    acc[1] += other[1]
+    acc[2] = min(acc[2], other[2])
+    acc[3] = max(acc[3], other[3])
+    for i in range(4, len(acc)):
+        acc[i] |= other[i]
+
+class Cube:
+    def __init__(self, facts, antigens, regions, economies):
+        # antigens / regions / economies: [(id, name), ...] in display order
+        country_bits = {}
+        base = {}   # (antigen, year, region, economy) -> accumulator
+        for antigen, year, region, economy, country, pct in facts:
+            bit = country_bits.get(country)
+            if bit is None:
+                bit = country_bits[country] = 1 << len(country_bits)
+            key = (antigen, year, region, economy)
+            acc = base.get(key)
+            if acc is None:
+                acc = base[key] = _new_acc()
+            acc[0] += 1
+            acc[1] += pct
+            if pct < acc[2]:
+                acc[2] = pct
+            if pct > acc[3]:
+                acc[3] = pct
+            acc[4] |= bit
+            for i, threshold in enumerate(THRESHOLDS, 5):
+                if pct >= threshold:
+                    acc[i] |= bit
+
+        # Members present in the facts
+        present = [set(key[d] for key in base) for d in range(len(DIMENSIONS))]
+
+        # Roll up one dimension at a time; after the last pass every combination of
+        # members and ALL is present (each pass also rolls up the earlier rollups).
+        cells = base
+        for d in range(len(DIMENSIONS)):
+            rolled = {}
+            for key, acc in cells.items():
+                up = key[:d] + (ALL,) + key[d + 1:]
+                target = rolled.get(up)
+                if target is None:
+                    target = rolled[up] = _new_acc()
+                _merge(target, acc)
+            cells.update(rolled)
+
+        self.cells = {
+            key: Cell(acc[0], acc[1] / acc[0], acc[2], acc[3], acc[4].bit_count(),
+                      {threshold: acc[i].bit_count() for i, threshold in enumerate(THRESHOLDS, 5)})
+            for key, acc in cells.items()
+        }
+
+        # Members in display order; None (no region/economy) last
+        self.labels = {
+            "antigen": dict(antigens),
+            "year": {year: str(year) for year in present[1]},
+            "region": dict(regions),
+            "economy": dict(economies),
+        }
+        self.members = {}
+        for d, dimension in enumerate(DIMENSIONS):
+            ordered = [m for m in self.labels[dimension] if m in present[d]]
+            if dimension == "year":
+                ordered.sort()
+            if None in present[d]:
+                ordered.append(None)
+            self.members[dimension] = ordered
+
+    @classmethod
+    def load(cls, db_path):
+        # Antigen and region names are the dropdowns' (refdata), not queried again
+        query = pyhtml.get_results_from_query
+        ref = refdata.get_refdata(db_path)
+        return cls(query(db_path, FACT_SQL), ref.antigens, ref.regions, query(db_path, ECONOMY_SQL))
+
+    def cell(self, antigen=ALL, year=ALL, region=ALL, economy=ALL):
+        """The Cell for one member (or ALL) of every dimension; None if it has no observations."""
+        return self.cells.get((antigen, year, region, economy))
+
+    def group(self, dimensions, **fixed):
+        """
+        [(key, Cell), ...] for every member combination of dimensions, in display order,
+        with the other dimensions at the member given in fixed (default ALL). A fixed
+        member restricts a grouped dimension to itself. Empty cells are left out.
+        """
+        unknown = set(fixed).union(dimensions).difference(DIMENSIONS)
+        if unknown:
+            raise ValueError(f"unknown cube dimension(s): {', '.join(sorted(unknown))}")
+        axes = []
+        for dimension in DIMENSIONS:
+            if dimension in fixed:
+                axes.append((fixed[dimension],))
+            elif dimension in dimensions:
+                axes.append(self.members[dimension])
+            else:
+                axes.append((ALL,))
+        cells = self.cells
+        return [(key, cells[key]) for key in itertools.product(*axes) if key in cells]
+
+    def label(self, dimension, member):
+        if member == ALL:
+            return "All"
+        if member is None:
+            return "Unclassified"
+        return self.labels[dimension].get(member, str(member))
+
+# ---------- shared instance, rebuilt when the database changes ----------
+def get_cube(db_path):
+    """The Cube for db_path; built on first use and again after every database change."""
+    return pyhtml.versioned_singleton(db_path, Cube.load)
+
+# ---------- page (/drilldown) ----------
+# Dimension the breakdown moves on to after a row is clicked (the first one not yet fixed)
+DRILL_ORDER = ("economy", "region", "antigen", "year")
+
+PAGE = templates.Template("""<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>Coverage Drill-down</title>
+  <link rel="stylesheet" href="{{stylesheet}}">
+</head>
+<body class="theme-green drilldown">
+  <header>
+    <h1>🧊 Vaccination Coverage Drill-down</h1>
+    <small>{{slice}}</small>
+  </header>
+
+  <form action="/drilldown" method="GET" class="filters">
+    <label>Antigen
+      <select name="antigen">
+        <option value="">All</option>
+        {{antigen_options}}
+      </select>
+    </label>
+    <label>Year
+      <select name="year">
+        <option value="">All</option>
+        {{year_options}}
+      </select>
+    </label>
+    <label>Region
+      <select name="region">
+        <option value="">All</option>
+        {{region_options}}
+      </select>
+    </label>
+    <label>Economy
+      <select name="economy">
+        <option value="">All</option>
+        {{economy_options}}
+      </select>
+    </label>
+    <label>Target %
+      <select name="threshold">
+        {{threshold_options}}
+      </select>
+    </label>
+    <label>Break down by
+      <select name="by">
+        {{by_options}}
+      </select>
+    </label>
+    <button type="submit">Apply</button>
+    <a href="/drilldown">Reset</a>
+  </form>
+
+  <div class="filters">{{breadcrumbs}}</div>
+
+  <h3>By {{by}}</h3>
+  <table>
+    <thead>
+      <tr><th>{{by_title}}</th><th>Countries reporting</th><th>Countries ≥{{threshold}}%</th><th>Share</th>
+          <th>Observations</th><th>Mean coverage %</th><th>Min %</th><th>Max %</th></tr>
+    </thead>
+    <tbody>
+      {{rows}}
+    </tbody>
+  </table>
+
+  <h3>Countries ≥{{threshold}}% by region and economy</h3>
+  <table>
+    <thead>
+      <tr><th>Region</th>{{economy_headers}}<th>All</th></tr>
+    </thead>
+    <tbody>
+      {{matrix_rows}}
+    </tbody>
+  </table>
+
+  <div class="footer">
+    <a href="/">← Back to Level 1A</a>
+    <a href="/page2">→ Level 2A</a>
+    <a href="/analytics">→ Coverage vs Incidence</a>
+  </div>
+</body>
+</html>""")
+
+THRESHOLD_OPTIONS = refdata.Options((t, t) for t in THRESHOLDS)
+BY_OPTIONS = refdata.Options((d, d.capitalize()) for d in DIMENSIONS)
+
+get_first = pyhtml.get_first
+
+def fmt(value, digits=1):
+    return f"{value:,.{digits}f}"
+
+def member_param(cube, dimension, value):
+    """The cube member for a form value (a label, as shown in the dropdowns), ALL if blank/unknown."""
+    if not value:
+        return ALL
+    for member in cube.members[dimension]:
+        if cube.label(dimension, member) == value:
+            return member
+    return ALL
+
+def page_link(cube, fixed, by, threshold):
+    params = {d: cube.label(d, fixed[d]) for d in DIMENSIONS if fixed[d] != ALL}
+    params["by"] = by
+    if threshold != DEFAULT_THRESHOLD:
+        params["threshold"] = threshold
+    return html.escape("/drilldown?" + urlencode(params))
+
+def cell_row(label, cell, threshold):
+    met = cell.met[threshold]
+    return (f"<tr><td>{label}</td><td>{cell.countries}</td><td>{met}</td>"
+            f"<td>{fmt(100 * met / cell.countries)}%</td><td>{cell.observations:,}</td>"
+            f"<td>{fmt(cell.mean)}</td><td>{fmt(cell.low)}</td><td>{fmt(cell.high)}</td></tr>")
+
+def get_page_html(form_data):
+    """
+    Any slice of the cube (antigen, year, region, economy: a member or All) broken down
+    by one dimension, plus a region x economy matrix of countries meeting the target.
+    Everything is a lookup in the in-memory cube; no queries unless the data changed.
+    """
+    cube = get_cube(DB_PATH)
+    ref = refdata.get_refdata(DB_PATH)
+    fixed = {d: member_param(cube, d, get_first(form_data, d)) for d in DIMENSIONS}
+    by = get_first(form_data, "by")
+    if by not in DIMENSIONS:
+        by = "economy"
+    try:
+        threshold = int(get_first(form_data, "threshold") or DEFAULT_THRESHOLD)
+    except ValueError:
+        threshold = DEFAULT_THRESHOLD
+    if threshold not in THRESHOLDS:
+        threshold = DEFAULT_THRESHOLD
+
+    # ---------- breakdown: the total, then one row per member of `by` ----------
+    rest = {d: m for d, m in fixed.items() if d != by}
+    rows = []
+    total = cube.cell(**{**rest, by: ALL})
+    if total is not None:
+        rows.append(cell_row("<strong>All</strong>", total, threshold))
+        next_by = next((d for d in DRILL_ORDER if d != by and fixed[d] == ALL), None)
+        for key, cell in cube.group((by,), **rest):
+            member = key[DIMENSIONS.index(by)]
+            label = html.escape(cube.label(by, member))
+            if next_by is not None:
+                label = f'<a href="{page_link(cube, {**fixed, by: member}, next_by, threshold)}">{label}</a>'
+            rows.append(cell_row(label, cell, threshold))
+
+    # Fixed dimensions, each with a link that rolls it back up to All
+    crumbs = []
+    for d in DIMENSIONS:
+        if fixed[d] != ALL:
+            link = page_link(cube, {**fixed, d: ALL}, by, threshold)
+            crumbs.append(f'{d.capitalize()}: {html.escape(cube.label(d, fixed[d]))} <a href="{link}">✕</a>')
+
+    # ---------- region x economy matrix for the selected antigen and year ----------
+    def met(region, economy):
+        cell = cube.cell(fixed["antigen"], fixed["year"], region, economy)
+        return cell.met[threshold] if cell is not None else 0
+
+    economies = cube.members["economy"] + [ALL]
+    matrix_rows = "".join(
+        f"<tr><td>{html.escape(cube.label('region', region))}</td>"
+        + "".join(f"<td>{met(region, economy)}</td>" for economy in economies) + "</tr>"
+        for region in cube.members["region"] + [ALL])
+
+    economy_options = refdata.Options((label, label) for label in
+                                      (cube.label("economy", m) for m in cube.members["economy"]))
+    return PAGE.render(
+        stylesheet=templates.static_url("css/site.css"),
+        slice=html.escape(" · ".join(f"{d.capitalize()}: {cube.label(d, fixed[d])}" for d in DIMENSIONS)),
+        antigen_options=ref.antigen_options.render(cube.label("antigen", fixed["antigen"])),
+        year_options=ref.year_options.render(fixed["year"]),
+        region_options=ref.region_options.render(cube.label("region", fixed["region"])),
+        economy_options=economy_options.render(cube.label("economy", fixed["economy"])),
+        threshold_options=THRESHOLD_OPTIONS.render(threshold),
+        by_options=BY_OPTIONS.render(by),
+        breadcrumbs=" &nbsp;·&nbsp; ".join(crumbs) or "All antigens, years, regions and economies",
+        by=by,
+        by_title=by.capitalize(),
+        threshold=threshold,
+        rows="".join(rows) or "<tr><td colspan='8'>No data</td></tr>",
+        economy_headers="".join(f"<th>{html.escape(cube.label('economy', m))}</th>"
+                                for m in cube.members["economy"]),
+        matrix_rows=matrix_rows,
+    )
@@ -1,4 +1,12 @@
 import pyhtml
+import metrics
+import query_profiler
+import migrate_db
+import coverage_store
+import refdata
+import api
+import analytics
+import cube
 import student_a_level_1
 import student_a_level_2
 import student_a_level_3
@@ -17,9 +25,32 @@ pyhtml.need_debugging_help = True
 pyhtml.MyRequestHandler.pages["/"] = student_a_level_1
 pyhtml.MyRequestHandler.pages["/page2"] = student_a_level_2
 pyhtml.MyRequestHandler.pages["/page3"] = student_a_level_3
+# Coverage vs incidence analytics (see analytics.py)
+pyhtml.MyRequestHandler.pages["/analytics"] = analytics
+# Coverage by antigen, year, region and economy with rollups (see cube.py)
+pyhtml.MyRequestHandler.pages["/drilldown"] = cube
+# Request counts, latency histograms and cache stats in Prometheus text format
+pyhtml.MyRequestHandler.pages["/metrics"] = metrics
+# JSON / CSV versions of the Level 2A and 3A datasets, and table exports (see api.py)
+for route, endpoint in api.ROUTES.items():
+    pyhtml.MyRequestHandler.pages[route] = endpoint
+# Query shapes, plans and slow queries (localhost only)
+pyhtml.MyRequestHandler.pages["/diagnostics"] = query_profiler
 
 # ✅ Enable query parameter parsing so form_data keeps Antigen / Year / Region values
 pyhtml.enable_query_parsing = True
 
+# Bring immunisation.db up to the schema the pages expect (no-op when already current)
+migrate_db.migrate()
+
+# Load the Level 3 coverage arrays now rather than on the first /page3 visit
+coverage_store.get_store(student_a_level_3.DB_PATH)
+# ... and the dropdown reference data (antigens, regions, years) for Levels 2A and 3A
+refdata.get_refdata(student_a_level_2.DB_PATH)
+# ... and the analytics matrices
+analytics.get_engine(analytics.DB_PATH)
+# ... and the coverage cube (Level 2A's regional counts, /drilldown)
+cube.get_cube(cube.DB_PATH)
+
 # Host the site
 pyhtml.host_site()
@@ -0,0 +1,307 @@
+# ingest.py
+"""
+Bulk loading of the yearly data refresh into immunisation.db.
+
+    python ingest.py load DIR            upsert DIR/<Table>.csv into the database
+    python ingest.py load DIR --wal      ... in place, in WAL mode (see below)
+    python ingest.py synth DIR --scale 10
+                                         write CSVs 10x the size of the current data
+    python ingest.py bench --scale 10    synth + load into a copy; report rows/s
+
+DIR may hold any of YearDate.csv, Country.csv, CountryPopulation.csv,
+Vaccination.csv and InfectionData.csv (loaded in that order). The header row
+names the table's columns (any case; unknown columns are ignored, the primary
+key columns are required) and empty fields become NULL. Rows are upserted
+(INSERT ... ON CONFLICT on the table's primary key DO UPDATE), so re-running
+a load, or loading a year that is already there, updates rather than fails.
+
+The load runs in one transaction with executemany() in batches of BATCH_ROWS.
+Indexes and triggers on the loaded tables are dropped first and recreated at
+the end; SummaryTotals (normally kept up to date by those triggers) is then
+rebuilt in one pass, and ANALYZE refreshes the planner statistics.
+
+The site keeps serving while this runs:
+  - default (swap): the database is copied to a temporary file next to it,
+    loaded there with journal_mode=OFF and synchronous=OFF (a failed load
+    just deletes the copy) and moved over the original with os.replace().
+    Pages keep reading the old file until the swap; pyhtml reconnects when
+    it sees the new inode, and every cache keyed on database_version() is
+    rebuilt.
+  - --wal: the database is switched to WAL mode (persistently) and loaded in
+    place with synchronous=NORMAL; readers see the old data until the commit.
+"""
+import argparse
+import csv
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import migrate_db
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "database", "immunisation.db")
+
+# Load order: dimension tables before the facts that refer to them
+TABLES = ["YearDate", "Country", "CountryPopulation", "Vaccination", "InfectionData"]
+BATCH_ROWS = 20000
+# Page cache for the loading connection (negative = KiB)
+LOAD_CACHE_KIB = 256 * 1024
+
+# ---------- schema ----------
+def table_columns(con, table):
+    """(columns, primary key columns) of table; generated columns are left out."""
+    info = con.execute(f"PRAGMA table_info({table})").fetchall()
+    if not info:
+        raise ValueError(f"no table {table}")
+    columns = [row[1] for row in info]
+    keys = [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]
+    return columns, keys
+
+def upsert_sql(table, columns, keys):
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    updates = [c for c in columns if c not in keys]
+    if updates:
+        sets = ", ".join(f"{c} = excluded.{c}" for c in updates)
+        return sql + f" ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {sets}"
+    return sql + f" ON CONFLICT ({', '.join(keys)}) DO NOTHING"
+
+def deferred_objects(con, tables):
+    """[(type, name, sql)] of the indexes and triggers on tables (not the automatic PK indexes)."""
+    marks = ", ".join("?" * len(tables))
+    return con.execute(f"""
+        SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND tbl_name IN ({marks}) AND sql IS NOT NULL
+        ORDER BY type, name""", tables).fetchall()
+
+# ---------- CSV sources ----------
+def read_csv(path, columns, keys):
+    """(columns found in the header, iterator of row tuples) for a CSV file."""
+    f = open(path, newline="", encoding="utf-8-sig")
+    reader = csv.reader(f)
+    try:
+        header = [name.strip().lower() for name in next(reader)]
+    except StopIteration:
+        f.close()
+        return [], iter(())
+    by_name = {c.lower(): c for c in columns}
+    picked = [(i, by_name[name]) for i, name in enumerate(header) if name in by_name]
+    found = [c for _, c in picked]
+    missing = [k for k in keys if k not in found]
+    if missing:
+        f.close()
+        raise ValueError(f"{path}: missing key column(s) {', '.join(missing)}")
+    index = [i for i, _ in picked]
+
+    def rows():
+        with f:
+            for record in reader:
+                if record:
+                    yield tuple((record[i] if i < len(record) else "") or None for i in index)
+    return found, rows()
+
+def batches(rows, size=BATCH_ROWS):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def sources(directory):
+    """[(table, path)] for the CSV files present in directory, in load order."""
+    return [(table, os.path.join(directory, table + ".csv")) for table in TABLES
+            if os.path.isfile(os.path.join(directory, table + ".csv"))]
+
+# ---------- loading ----------
+def load(con, files, verbose=False):
+    """
+    Upsert every (table, path) in files through con (isolation_level=None) in one
+    transaction. Returns {table: (rows, seconds)}, plus "rebuild" for the deferred work.
+    """
+    stats = {}
+    tables = [table for table, _ in files]
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        deferred = deferred_objects(con, tables)
+        for kind, name, _ in deferred:
+            con.execute(f"DROP {kind.upper()} {name}")
+        for table, path in files:
+            started = time.perf_counter()
+            columns, keys = table_columns(con, table)
+            found, rows = read_csv(path, columns, keys)
+            count = 0
+            if found:
+                sql = upsert_sql(table, found, keys)
+                for batch in batches(rows):
+                    con.executemany(sql, batch)
+                    count += len(batch)
+            stats[table] = (count, time.perf_counter() - started)
+            if verbose:
+                print(f"  {table:18} {count:>10,} rows {stats[table][1]:8.2f}s")
+        started = time.perf_counter()
+        for _, _, sql in deferred:
+            con.execute(sql)
+        for statement in migrate_db.REFRESH_SUMMARY_SQL.split(";"):
+            if statement.strip():
+                con.execute(statement)
+        con.execute("ANALYZE")
+        con.execute("COMMIT")
+        stats["rebuild"] = (0, time.perf_counter() - started)
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    return stats
+
+def ingest(directory, db_path=DB_PATH, wal=False, verbose=False):
+    """Load the CSVs in directory into db_path while it stays readable. Returns load() stats."""
+    files = sources(directory)
+    if not files:
+        raise ValueError(f"no {', '.join(t + '.csv' for t in TABLES)} in {directory}")
+    # Bring the schema up to date first: the summary tables are rebuilt from it.
+    migrate_db.migrate(db_path)
+    if wal:
+        con = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute(f"PRAGMA cache_size=-{LOAD_CACHE_KIB}")
+            stats = load(con, files, verbose)
+            # Fold the WAL back in as far as readers allow
+            con.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        finally:
+            con.close()
+        return stats
+
+    if os.path.exists(db_path + "-wal"):
+        # The old WAL would be replayed into the swapped-in file; load in place instead.
+        raise ValueError(f"{db_path} is in WAL mode: use --wal")
+    fd, tmp_path = tempfile.mkstemp(prefix=".ingest-", suffix=".db", dir=os.path.dirname(db_path))
+    os.close(fd)
+    try:
+        source = sqlite3.connect(db_path)
+        con = sqlite3.connect(tmp_path, isolation_level=None)
+        try:
+            source.backup(con)   # a consistent snapshot, even while pages read the original
+            con.execute("PRAGMA journal_mode=OFF")
+            con.execute("PRAGMA synchronous=OFF")
+            con.execute(f"PRAGMA cache_size=-{LOAD_CACHE_KIB}")
+            stats = load(con, files, verbose)
+        finally:
+            con.close()
+            source.close()
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        shutil.copymode(db_path, tmp_path)
+        os.replace(tmp_path, db_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return stats
+
+# ---------- synthetic data ----------
+def synthesize(directory, db_path=DB_PATH, scale=10, seed=0):
+    """
+    Write CSVs for every table in TABLES with `scale` times the rows of db_path:
+    copy 0 is the existing data (so it exercises the update path), copies 1.. are
+    new countries with jittered values. Returns {table: rows written}.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    written = {}
+
+    def jitter(value, k):
+        if k == 0 or value in (None, ""):
+            return value
+        return round(float(value) * rng.uniform(0.9, 1.1), 2)
+
+    def country(cid, k):
+        return cid if k == 0 else f"{cid}{k}"
+
+    try:
+        for table in TABLES:
+            columns, keys = table_columns(con, table)
+            rows = con.execute(f"SELECT {', '.join(columns)} FROM {table}").fetchall()
+            count = 0
+            with open(os.path.join(directory, table + ".csv"), "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                copies = 1 if table == "YearDate" else scale
+                for k in range(copies):
+                    out = []
+                    for row in rows:
+                        record = dict(zip(columns, row))
+                        if table == "Country":
+                            record["CountryID"] = country(record["CountryID"], k)
+                            record["name"] = record["name"] if k == 0 else f"{record['name']} #{k}"
+                        elif "country" in record:
+                            record["country"] = country(record["country"], k)
+                            for c in ("population", "target_num", "doses", "coverage", "cases"):
+                                if c in record:
+                                    record[c] = jitter(record[c], k)
+                        out.append([record[c] for c in columns])
+                    writer.writerows(out)
+                    count += len(out)
+            written[table] = count
+    finally:
+        con.close()
+    return written
+
+def bench(scale=10, wal=False, db_path=DB_PATH):
+    """Synthesize `scale`x data and load it into a copy of db_path; prints rows/s per table."""
+    with tempfile.TemporaryDirectory(prefix="ingest-bench-") as tmp:
+        copy = os.path.join(tmp, "immunisation.db")
+        source, target = sqlite3.connect(db_path), sqlite3.connect(copy)
+        source.backup(target)
+        source.close()
+        target.close()
+        started = time.perf_counter()
+        written = synthesize(os.path.join(tmp, "csv"), copy, scale)
+        print(f"Synthesized {sum(written.values()):,} rows ({scale}x) in {time.perf_counter() - started:.1f}s")
+        started = time.perf_counter()
+        stats = ingest(os.path.join(tmp, "csv"), copy, wal=wal)
+        total = time.perf_counter() - started
+    print(f"\n{'table':18} {'rows':>10} {'seconds':>8} {'rows/s':>10}")
+    for table, (rows, seconds) in stats.items():
+        rate = f"{rows / seconds:10,.0f}" if rows and seconds else f"{'':>10}"
+        print(f"{table:18} {rows:>10,} {seconds:8.2f} {rate}")
+    rows = sum(r for r, _ in stats.values())
+    print(f"{'total':18} {rows:>10,} {total:8.2f} {rows / total:10,.0f}")
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load CSV data into immunisation.db.")
+    parser.add_argument("mode", choices=["load", "synth", "bench"])
+    parser.add_argument("directory", nargs="?", help="load/synth: folder of <Table>.csv files")
+    parser.add_argument("--db", default=DB_PATH, help="database file (default: %(default)s)")
+    parser.add_argument("--wal", action="store_true", help="load in place in WAL mode instead of swapping files")
+    parser.add_argument("--scale", type=int, default=10, help="synth/bench: multiple of the current row count")
+    args = parser.parse_args(argv)
+
+    if args.mode == "bench":
+        bench(args.scale, args.wal, args.db)
+        return 0
+    if not args.directory:
+        parser.error(f"{args.mode} needs a directory")
+    if args.mode == "synth":
+        written = synthesize(args.directory, args.db, args.scale)
+        for table, rows in written.items():
+            print(f"{table:18} {rows:>10,} rows")
+        return 0
+    print(f"Loading {args.directory} into {args.db}")
+    started = time.perf_counter()
+    stats = ingest(args.directory, args.db, args.wal, verbose=True)
+    rows = sum(r for r, _ in stats.values())
+    elapsed = time.perf_counter() - started
+    print(f"{rows:,} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# metrics.py
+"""
+Request counters, in-flight gauges and per-phase latency histograms for pyhtml,
+rendered in Prometheus text format.
+
+Register the module as a page to expose it:
+    pyhtml.MyRequestHandler.pages["/metrics"] = metrics
+
+Recording a request costs a few dictionary updates under one lock, so it is
+always on.
+"""
+import bisect
+import threading
+
+# Page attributes honoured by pyhtml.MyRequestHandler
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+cacheable = False
+
+# Latency buckets in seconds (upper bounds; +Inf is implicit)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+_lock = threading.Lock()
+requests_total = {}     # (route, status) -> count
+in_flight = {}          # route -> requests currently being served
+durations = {}          # route -> Histogram of whole-request time
+phase_durations = {}    # (route, phase) -> Histogram
+# Callables returning extra exposition lines (e.g. response-cache stats from pyhtml)
+collectors = []
+
+def request_started(route):
+    with _lock:
+        in_flight[route] = in_flight.get(route, 0) + 1
+
+def request_finished(route, status, total, phases):
+    """Record one finished request: total seconds and {phase: seconds}."""
+    with _lock:
+        in_flight[route] = in_flight.get(route, 1) - 1
+        key = (route, status)
+        requests_total[key] = requests_total.get(key, 0) + 1
+        histogram = durations.get(route)
+        if histogram is None:
+            histogram = durations[route] = Histogram()
+        histogram.observe(total)
+        for phase, seconds in phases.items():
+            histogram = phase_durations.get((route, phase))
+            if histogram is None:
+                histogram = phase_durations[(route, phase)] = Histogram()
+            histogram.observe(seconds)
+
+def server_timing(phases):
+    """Server-Timing header value for {phase: seconds}."""
+    return ", ".join(f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in phases.items())
+
+# ---------- Prometheus exposition ----------
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(**labels):
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+def _histogram_lines(name, histogram, **labels):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+    return lines
+
+def render():
+    with _lock:
+        lines = [
+            "# HELP pyhtml_requests_total HTTP requests served, by route and status.",
+            "# TYPE pyhtml_requests_total counter",
+        ]
+        lines += [f"pyhtml_requests_total{_labels(route=r, status=s)} {n}"
+                  for (r, s), n in sorted(requests_total.items())]
+        lines += [
+            "# HELP pyhtml_requests_in_flight Requests currently being served.",
+            "# TYPE pyhtml_requests_in_flight gauge",
+        ]
+        lines += [f"pyhtml_requests_in_flight{_labels(route=r)} {n}" for r, n in sorted(in_flight.items())]
+        lines += [
+            "# HELP pyhtml_request_duration_seconds Whole-request latency.",
+            "# TYPE pyhtml_request_duration_seconds histogram",
+        ]
+        for route, histogram in sorted(durations.items()):
+            lines += _histogram_lines("pyhtml_request_duration_seconds", histogram, route=route)
+        lines += [
+            "# HELP pyhtml_request_phase_seconds Time per request phase (parse, cache, db, render, compress, write).",
+            "# TYPE pyhtml_request_phase_seconds histogram",
+        ]
+        for (route, phase), histogram in sorted(phase_durations.items()):
+            lines += _histogram_lines("pyhtml_request_phase_seconds", histogram, route=route, phase=phase)
+    for collect in collectors:
+        lines += collect()
+    return "\n".join(lines) + "\n"
+
+def get_page_html(form_data):
+    return render()
@@ -0,0 +1,185 @@
+# migrate_db.py
+"""
+Schema migrations for immunisation.db.
+
+Migrations are numbered; the number of the last one applied is kept in
+PRAGMA user_version, so running this again only applies what is missing.
+
+Usage (from the milestone folder):
+    python migrate_db.py              apply pending migrations
+    python migrate_db.py --refresh    rebuild the summary tables from the fact tables
+    python migrate_db.py --explain    print EXPLAIN QUERY PLAN for every page query
+"""
+import os
+import sqlite3
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "database", "immunisation.db")
+
+# ---------- migration 1: materialized summary for the Level 1 overview ----------
+# SummaryTotals holds doses and cases per (inf_type, year). Per-type, per-year and
+# overall totals are sums over at most (types x years) rows instead of the fact tables.
+# Triggers keep it in step with every INSERT / UPDATE / DELETE on the fact tables.
+SUMMARY_SQL = """
+CREATE TABLE IF NOT EXISTS SummaryTotals (
+    inf_type TEXT (3) NOT NULL,
+    year     INTEGER  NOT NULL,
+    doses    REAL     NOT NULL DEFAULT 0,
+    cases    REAL     NOT NULL DEFAULT 0,
+    PRIMARY KEY (inf_type, year)
+);
+
+CREATE VIEW IF NOT EXISTS SummaryOverview AS
+SELECT
+    (SELECT MIN(YearID) FROM YearDate)             AS min_year,
+    (SELECT MAX(YearID) FROM YearDate)             AS max_year,
+    (SELECT COALESCE(SUM(doses),0) FROM SummaryTotals) AS total_doses,
+    (SELECT COALESCE(SUM(cases),0) FROM SummaryTotals) AS total_cases;
+
+CREATE TRIGGER IF NOT EXISTS summary_vaccination_insert AFTER INSERT ON Vaccination
+BEGIN
+    INSERT INTO SummaryTotals (inf_type, year, doses) VALUES (NEW.inf_type, NEW.year, COALESCE(CAST(NEW.doses AS REAL),0))
+    ON CONFLICT (inf_type, year) DO UPDATE SET doses = doses + excluded.doses;
+END;
+
+CREATE TRIGGER IF NOT EXISTS summary_vaccination_delete AFTER DELETE ON Vaccination
+BEGIN
+    UPDATE SummaryTotals SET doses = doses - COALESCE(CAST(OLD.doses AS REAL),0)
+    WHERE inf_type = OLD.inf_type AND year = OLD.year;
+END;
+
+CREATE TRIGGER IF NOT EXISTS summary_vaccination_update AFTER UPDATE OF inf_type, year, doses ON Vaccination
+BEGIN
+    UPDATE SummaryTotals SET doses = doses - COALESCE(CAST(OLD.doses AS REAL),0)
+    WHERE inf_type = OLD.inf_type AND year = OLD.year;
+    INSERT INTO SummaryTotals (inf_type, year, doses) VALUES (NEW.inf_type, NEW.year, COALESCE(CAST(NEW.doses AS REAL),0))
+    ON CONFLICT (inf_type, year) DO UPDATE SET doses = doses + excluded.doses;
+END;
+
+CREATE TRIGGER IF NOT EXISTS summary_infection_insert AFTER INSERT ON InfectionData
+BEGIN
+    INSERT INTO SummaryTotals (inf_type, year, cases) VALUES (NEW.inf_type, NEW.year, COALESCE(CAST(NEW.cases AS REAL),0))
+    ON CONFLICT (inf_type, year) DO UPDATE SET cases = cases + excluded.cases;
+END;
+
+CREATE TRIGGER IF NOT EXISTS summary_infection_delete AFTER DELETE ON InfectionData
+BEGIN
+    UPDATE SummaryTotals SET cases = cases - COALESCE(CAST(OLD.cases AS REAL),0)
+    WHERE inf_type = OLD.inf_type AND year = OLD.year;
+END;
+
+CREATE TRIGGER IF NOT EXISTS summary_infection_update AFTER UPDATE OF inf_type, year, cases ON InfectionData
+BEGIN
+    UPDATE SummaryTotals SET cases = cases - COALESCE(CAST(OLD.cases AS REAL),0)
+    WHERE inf_type = OLD.inf_type AND year = OLD.year;
+    INSERT INTO SummaryTotals (inf_type, year, cases) VALUES (NEW.inf_type, NEW.year, COALESCE(CAST(NEW.cases AS REAL),0))
+    ON CONFLICT (inf_type, year) DO UPDATE SET cases = cases + excluded.cases;
+END;
+"""
+
+REFRESH_SUMMARY_SQL = """
+DELETE FROM SummaryTotals;
+INSERT INTO SummaryTotals (inf_type, year, doses, cases)
+SELECT inf_type, year, SUM(doses), SUM(cases) FROM (
+    SELECT inf_type, year, COALESCE(CAST(doses AS REAL),0) AS doses, 0 AS cases FROM Vaccination
+    UNION ALL
+    SELECT inf_type, year, 0, COALESCE(CAST(cases AS REAL),0) FROM InfectionData
+)
+GROUP BY inf_type, year;
+"""
+
+def refresh_summary(con):
+    """Recompute SummaryTotals from scratch (after bulk loads or to repair drift)."""
+    con.executescript("BEGIN;" + REFRESH_SUMMARY_SQL + "COMMIT;")
+
+# ---------- migration 2: numeric coverage column + indexes for Levels 2 and 3 ----------
+# coverage holds REALs and '' for missing values. coverage_pct is the same value as a
+# clean REAL (blank -> NULL), generated by SQLite so every insert/update maintains it.
+# The indexes match the page access patterns:
+#   (coverage_pct, ...)         Level 2 with no filters: range scan on coverage_pct >= 90
+#   (antigen, year, coverage_pct) Level 2 by antigen/year, Level 3 start-year side
+#   (year, antigen, country)     Level 3 end-year side of the self-join, DISTINCT year lists
+COVERAGE_SQL = """
+ALTER TABLE Vaccination ADD COLUMN coverage_pct REAL
+    GENERATED ALWAYS AS (CAST(NULLIF(TRIM(CAST(coverage AS TEXT)), '') AS REAL)) VIRTUAL;
+
+CREATE INDEX IF NOT EXISTS idx_vaccination_coverage
+    ON Vaccination (coverage_pct, antigen, year, country);
+CREATE INDEX IF NOT EXISTS idx_vaccination_antigen_year
+    ON Vaccination (antigen, year, coverage_pct, country);
+CREATE INDEX IF NOT EXISTS idx_vaccination_year_antigen_country
+    ON Vaccination (year, antigen, country, coverage_pct);
+
+ANALYZE;
+"""
+
+# (version, description, SQL script) in the order they must be applied
+MIGRATIONS = [
+    (1, "materialized summary totals for Level 1", SUMMARY_SQL + REFRESH_SUMMARY_SQL),
+    (2, "numeric coverage column and covering indexes", COVERAGE_SQL),
+]
+
+def migrate(db_path=DB_PATH, verbose=False):
+    """Apply every migration newer than the database's user_version. Returns the new version."""
+    con = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        current = con.execute("PRAGMA user_version;").fetchone()[0]
+        for version, description, script in MIGRATIONS:
+            if version <= current:
+                continue
+            if verbose:
+                print(f"Applying migration {version}: {description}")
+            # One transaction per migration: either all of it lands, or none of it.
+            try:
+                con.executescript(f"BEGIN;{script}PRAGMA user_version = {version};COMMIT;")
+            except Exception:
+                if con.in_transaction:
+                    con.execute("ROLLBACK;")
+                raise
+            current = version
+        return current
+    finally:
+        con.close()
+
+def explain_page_queries(db_path=DB_PATH):
+    """Print EXPLAIN QUERY PLAN for the Level 2 and 3 page queries."""
+    import cube
+    import student_a_level_2
+    import student_a_level_3
+
+    antigen = "Measles-containing vaccine, 1st dose"
+    queries = [
+        ("Level 2 countries, no filters", student_a_level_2.countries_query()),
+        ("Level 2 countries, antigen+year", student_a_level_2.countries_query(antigen, "2004")),
+        ("Level 2 countries, next page",
+         student_a_level_2.countries_query(after=(95.0, "Kenya", antigen, 2004), limit=201)),
+        ("Cube facts (Level 2 region counts)", (cube.FACT_SQL, ())),
+        ("Level 3 improvement", student_a_level_3.improvement_query(2000, 2024)),
+        ("Level 3 improvement, antigen", student_a_level_3.improvement_query(2000, 2024, antigen)),
+    ]
+    con = sqlite3.connect(db_path)
+    try:
+        for title, (sql, params) in queries:
+            print(title)
+            for row in con.execute("EXPLAIN QUERY PLAN " + sql, params):
+                print("   ", row[3])
+    finally:
+        con.close()
+
+def main(argv):
+    db_path = DB_PATH
+    version = migrate(db_path, verbose=True)
+    print(f"{db_path} is at schema version {version}")
+    if "--refresh" in argv:
+        con = sqlite3.connect(db_path, isolation_level=None)
+        try:
+            refresh_summary(con)
+        finally:
+            con.close()
+        print("Summary tables refreshed")
+    if "--explain" in argv:
+        explain_page_queries(db_path)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
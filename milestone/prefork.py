@@ -0,0 +1,205 @@
+# prefork.py
+"""
+Multi-process (prefork) serving for pyhtml, so page rendering can use every
+CPU core instead of sharing one GIL.
+
+    pyhtml.host_site(port=8080, processes=4)                     # 4 x threaded server
+    pyhtml.host_site(port=8080, processes=4, server="asyncio")   # 4 x asyncio server
+
+The supervisor (the process that calls host_site) binds the listening socket
+once and forks `processes` workers that inherit it; the kernel hands each new
+connection to one of them. Everything imported before host_site() (page
+modules, the coverage store) is shared copy-on-write. Each worker opens its
+own read-only SQLite connections; pooled connections inherited from the
+supervisor are never used by a child (see pyhtml's fork handler).
+
+The supervisor:
+  - restarts a worker that exits unexpectedly (at most once a second per slot)
+  - SIGHUP: rolling reload - starts a new worker, waits until it is accepting,
+    then stops one old worker gracefully, one slot at a time. Workers are
+    forked from the supervisor, so this picks up a new database file and
+    empties the per-process caches, not edited Python code (restart for that).
+  - SIGTERM / SIGINT: stops every worker gracefully (forcefully after
+    STOP_TIMEOUT seconds) and exits.
+
+Metrics (/metrics, /diagnostics) are per worker process.
+"""
+import os
+import select
+import signal
+import socket
+import threading
+import time
+
+import pyhtml
+
+STOP_TIMEOUT = 15       # seconds a worker gets to finish in-flight requests
+READY_TIMEOUT = 30      # seconds a new worker may take before it accepts connections
+RESTART_DELAY = 1.0     # minimum seconds between restarts of a crashing worker
+
+SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+
+class Supervisor:
+    def __init__(self, port, processes=None, workers=pyhtml.DEFAULT_WORKERS, server=None):
+        self.port = port
+        self.processes = max(1, int(processes or os.cpu_count() or 1))
+        self.workers = workers
+        self.server = server or pyhtml.SERVER_MODE
+        self.children = {}      # pid -> time.monotonic() when started
+        self.retiring = set()   # pids asked to stop by a reload; not restarted
+        self.stopping = False
+
+    def run(self):
+        self.sock = socket.create_server(("", self.port), backlog=128)
+        try:
+            for _ in range(self.processes):
+                self.spawn()
+            while self.children:
+                info = signal.sigtimedwait(SIGNALS, 1.0)
+                if info is None:
+                    continue
+                if info.si_signo == signal.SIGHUP and not self.stopping:
+                    self.reload()
+                elif info.si_signo in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                self.reap()
+        finally:
+            self.sock.close()
+
+    # ---------- workers ----------
+    def spawn(self):
+        """Fork a worker; returns (pid, fd that becomes readable once it is accepting)."""
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            code = 1
+            try:
+                run_worker(self.sock, self.server, self.workers, ready_w)
+                code = 0
+            except BaseException:
+                pyhtml.logger.exception("worker %d failed", os.getpid())
+            finally:
+                pyhtml.stop_logging()
+                os._exit(code)
+        os.close(ready_w)
+        self.children[pid] = time.monotonic()
+        pyhtml.logger.info("started worker %d (%d running)", pid, len(self.children))
+        return pid, ready_r
+
+    def reap(self):
+        """Collect exited workers and restart the ones that were not asked to stop."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            if pid in self.retiring or self.stopping:
+                self.retiring.discard(pid)
+                continue
+            pyhtml.logger.warning("worker %d exited unexpectedly (status %d); restarting", pid, status)
+            # A worker that dies on start-up would otherwise be restarted in a tight loop.
+            wait = RESTART_DELAY - (time.monotonic() - started)
+            if wait > 0:
+                time.sleep(wait)
+            _, ready = self.spawn()
+            os.close(ready)
+
+    def reload(self):
+        """Replace the workers one at a time, never dropping below the configured count."""
+        pyhtml.logger.info("rolling reload of %d worker(s)", len(self.children))
+        for old in list(self.children):
+            new, ready = self.spawn()
+            try:
+                if not select.select([ready], [], [], READY_TIMEOUT)[0] or not os.read(ready, 1):
+                    pyhtml.logger.error("new worker %d did not start; keeping %d", new, old)
+                    continue
+            finally:
+                os.close(ready)
+            self.retire(old)
+
+    def retire(self, pid):
+        """Ask one worker to finish its requests and exit; wait for it (up to STOP_TIMEOUT)."""
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while pid in self.children and time.monotonic() < deadline:
+            signal.sigtimedwait({signal.SIGCHLD}, 0.2)
+            self.reap()
+        if pid in self.children:
+            os.kill(pid, signal.SIGKILL)
+
+    def stop(self):
+        self.stopping = True
+        pyhtml.logger.info("stopping %d worker(s)", len(self.children))
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while self.children and time.monotonic() < deadline:
+            signal.sigtimedwait({signal.SIGCHLD}, 0.2)
+            self.reap()
+        for pid in list(self.children):
+            os.kill(pid, signal.SIGKILL)
+        while self.children:
+            pid, _ = os.waitpid(-1, 0)
+            self.children.pop(pid, None)
+
+def run_worker(sock, server, workers, ready_fd):
+    """Body of a worker process: serve on the inherited socket until SIGTERM."""
+    # Ctrl-C reaches the whole process group; the supervisor decides when workers stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    pyhtml.configure_logging()
+
+    def ready():
+        try:
+            os.write(ready_fd, b"1")
+        except OSError:  # nobody is waiting (a restart, not a reload)
+            pass
+        os.close(ready_fd)
+
+    if server == "asyncio":
+        import async_server
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+        async_server.serve(sock=sock, workers=workers, on_ready=ready)
+        return
+
+    httpd = pyhtml.PooledHTTPServer(None, pyhtml.MyRequestHandler, workers=workers, sock=sock)
+    # shutdown() waits for serve_forever() to return, so it cannot run on this thread.
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=httpd.shutdown).start())
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+    ready()
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+
+def host_site(port=80, processes=None, workers=pyhtml.DEFAULT_WORKERS, server=None):
+    supervisor = Supervisor(port, processes, workers, server)
+    # The supervisor takes its signals synchronously with sigtimedwait, never in a handler
+    # (e.g. mid-fork). They must be blocked before any thread (the log writer) starts,
+    # or the kernel may deliver them to that thread instead.
+    signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+    pyhtml.configure_logging()
+    print("Using your favourite browser, go to:\n")
+    if port == 80:
+        print("http://localhost")
+    print(f"or\nhttp://localhost:{port}\n")
+    print(f"Serving with {supervisor.processes} {supervisor.server} worker process(es) "
+          f"of {supervisor.workers} thread(s) each (supervisor pid {os.getpid()})\n")
+    try:
+        supervisor.run()
+    finally:
+        pyhtml.stop_logging()
@@ -4,63 +4,1424 @@
 
 import sqlite3
 import os
+import sys
+import time
+import random
+import queue
+import logging
+import logging.handlers
+import threading
+import selectors
+import hashlib
+import ipaddress
+import gzip
+import zlib
+import mimetypes
+import stat
+import posixpath
+import email.utils
+import functools
+import math
+from collections import OrderedDict, namedtuple
+from urllib.request import pathname2url
 
+import http.client
 import http.server
-import socketserver
-from urllib.parse import parse_qs, urlparse
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlparse
+
+import admission
+import metrics
+import query_profiler
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; without it only gzip is offered
+    brotli = None
 
 need_debugging_help=True
 
+# ---------- Logging ----------
+# Everything goes through the "pyhtml" logger. configure_logging() (called by host_site)
+# hands records to a background thread through a bounded queue, so request threads
+# never wait on stdout. need_debugging_help=True means DEBUG level, otherwise INFO.
+logger=logging.getLogger("pyhtml")
+access_logger=logging.getLogger("pyhtml.access")
+
+LOG_LEVEL=None               # None: DEBUG if need_debugging_help else INFO
+LOG_QUEUE_SIZE=10000         # records waiting for the writer thread; beyond this they are dropped
+LOG_RESULT_ROWS=5            # result rows shown in a DEBUG query record
+LOG_RESULT_SAMPLE_RATE=1.0   # fraction of queries whose result rows are logged
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full."""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the writer thread; only the record is queued.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class ResultPreview:
+    """Result rows for a log message, truncated to LOG_RESULT_ROWS; rendered only if emitted."""
+    __slots__ = ("rows",)
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __str__(self):
+        shown = ", ".join(repr(row) for row in self.rows[:LOG_RESULT_ROWS])
+        more = len(self.rows) - LOG_RESULT_ROWS
+        return f"[{shown}{f', ... {more} more' if more > 0 else ''}]"
+
+class CompactSQL:
+    """SQL text with whitespace collapsed, rendered only if the record is emitted."""
+    __slots__ = ("sql",)
+    def __init__(self, sql):
+        self.sql = sql
+
+    def __str__(self):
+        return " ".join(self.sql.split())
+
+_log_listener=None
+
+def configure_logging(level=None, stream=None):
+    """Send pyhtml's log records through a queue to a writer thread (idempotent)."""
+    global _log_listener
+    if level is None:
+        level = LOG_LEVEL if LOG_LEVEL is not None else (logging.DEBUG if need_debugging_help else logging.INFO)
+    logger.setLevel(level)
+    if _log_listener is not None:
+        return
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    logger.propagate = False
+    _log_listener = logging.handlers.QueueListener(log_queue, output)
+    _log_listener.start()
+
+def stop_logging():
+    """Flush queued records and stop the writer thread."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+# Default number of worker threads used by host_site() to serve requests concurrently.
+DEFAULT_WORKERS=8
+# Seconds an idle keep-alive connection may hold on to a worker before it is closed.
+KEEP_ALIVE_TIMEOUT=5
+# A connection idle for IDLE_GIVE_WAY_AFTER seconds is closed as soon as another connection
+# is queued for a worker, checked every IDLE_POLL_INTERVAL (a browser's requests for a page
+# and its images come closer together than that, so they keep their connection).
+IDLE_GIVE_WAY_AFTER=0.25
+IDLE_POLL_INTERVAL=0.05
+# host_site() server: "threads" (a worker per connection) or "asyncio" (see async_server.py)
+SERVER_MODE="threads"
+# host_site() server processes; more than 1 forks workers that share the port (see prefork.py)
+PROCESSES=1
+# host_site() copies every page's database (DB_PATH) into memory and serves queries from there
+IN_MEMORY=False
+
+# ---------- Admission control (see admission.py) ----------
+# Connections waiting for a worker thread, beyond which new ones get an immediate 503.
+ACCEPT_QUEUE_SIZE=64
+# Seconds a connection (or, with asyncio, a page) may wait for a worker before it gets a 503 instead.
+ACCEPT_QUEUE_TIMEOUT=2.0
+# Pages rendered at once (cache hits do not count), overall and per route; None means no limit.
+MAX_CONCURRENT_PAGES=64
+ROUTE_CONCURRENCY={}        # e.g. {"/page3": 2}
+# Token bucket per client for pages that set `rate_limited`: (requests per second, burst), or None.
+RATE_LIMIT=(2.0, 10)
+# Retry-After (seconds) sent with a 503.
+RETRY_AFTER=1
+
+# Pragmas applied once to every pooled (read-only) SQLite connection.
+SQLITE_PRAGMAS={
+    "query_only": "ON",         # the pages only ever read
+    "mmap_size": 64*1024*1024,  # map the whole database instead of read() calls
+    "cache_size": -16000,       # ~16 MB page cache per connection
+    "temp_store": "MEMORY",     # ORDER BY / DISTINCT temp b-trees stay in RAM
+}
+# Prepared statements kept per connection; the pages use a small, fixed set of queries.
+STATEMENT_CACHE_SIZE=64
+# Rows fetched from SQLite at a time by iter_batches() / iter_rows().
+FETCH_BATCH_SIZE=256
+# Results of up to this many rows are kept by a QueryContext for repeats of the same query.
+QUERY_MEMO_MAX_ROWS=5000
+
+# Memory cap for rendered pages kept by the response cache.
+RESPONSE_CACHE_MAX_BYTES=64*1024*1024
+# Streamed pages are sent in chunks of about this many bytes.
+STREAM_CHUNK_SIZE=16*1024
+
+# Responses smaller than this are sent uncompressed (streamed pages are always compressed).
+COMPRESS_MIN_SIZE=1024
+GZIP_LEVEL=6
+BROTLI_QUALITY=5
+# Static files of these types are compressed once and the variants kept in memory.
+COMPRESSIBLE_TYPES={"text/html", "text/css", "text/plain", "text/csv", "text/javascript",
+                    "application/javascript", "application/json", "image/svg+xml", "application/xml"}
+STATIC_COMPRESS_MAX_SIZE=4*1024*1024
+# Memory cap for the compressed copies of files too big to keep in memory themselves.
+STATIC_VARIANTS_MAX_BYTES=16*1024*1024
+# Static files up to this size are kept in memory as ready-made responses (with their
+# compressed variants); larger ones are sent straight from disk with sendfile().
+STATIC_CACHE_FILE_MAX_SIZE=256*1024
+# Memory cap for the static files kept in memory (bodies plus compressed variants).
+STATIC_CACHE_MAX_BYTES=32*1024*1024
+# Seconds between checks that a static file kept in memory is unchanged on disk.
+STATIC_CHECK_INTERVAL=1.0
+# Cache-Control max-age for static files.
+STATIC_MAX_AGE=3600
+# ... and for versioned links (templates.static_url adds ?v=<content hash>), which never change.
+STATIC_VERSIONED_MAX_AGE=365*24*3600
+
+# ---------- Rendered-page response cache ----------
+def database_version(database):
+    """
+    Cheap token that changes whenever database (or its WAL file) is written or replaced.
+    Returns None if the file does not exist.
+    """
+    version = []
+    for path in (database, database + "-wal"):
+        try:
+            st = os.stat(path)
+        except OSError:
+            version.append(None)
+            continue
+        version.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(version) if version[0] is not None else None
+
+# Objects built from a database (reference data, in-memory stores), shared by all requests
+_versioned = {}  # (loader, database) -> (database version, object)
+_versioned_locks = {}
+
+def versioned_singleton(database, loader):
+    """
+    loader(database), built once and shared until database_version(database) changes;
+    then the next caller builds it again while the others wait for the new one.
+    """
+    key = (loader, database)
+    version = database_version(database)
+    cached = _versioned.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _versioned_locks.setdefault(key, threading.Lock()):
+        cached = _versioned.get(key)
+        if cached is None or cached[0] != version:
+            cached = _versioned[key] = (version, loader(database))
+    return cached[1]
+
+def normalize_form_data(form_data):
+    """Turn parse_qs() output into a hashable key that ignores parameter order."""
+    return tuple(sorted((key, tuple(values)) for key, values in form_data.items()))
+
+def get_first(form_data, key):
+    """First value of query param key, stripped; None if missing or empty."""
+    v = form_data.get(key)
+    if isinstance(v, list):
+        v = v[0] if v else None
+    return v.strip() if v else None
+
+class ResponseCache:
+    """
+    LRU cache of rendered pages keyed by (route, normalized form data).
+    Each entry remembers the database version it was rendered from and is
+    dropped as soon as that version changes.
+    """
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        """Return (etag, body, content_encoding) for key if it was cached for version, else None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != version:
+                self._remove(key)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1:]
+
+    def put(self, key, version, etag, body, encoding=None):
+        # A single page may use at most an eighth of the cache.
+        if len(body) > self.max_bytes // 8:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (version, etag, body, encoding)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= len(self.entries.pop(key)[2])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+response_cache=ResponseCache()
+
+def response_cache_metrics():
+    stats = response_cache.stats()
+    lines = []
+    for name, kind in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                       ("invalidations", "counter"), ("entries", "gauge"), ("bytes", "gauge")):
+        metric = f"pyhtml_response_cache_{name}" + ("_total" if kind == "counter" else "")
+        lines += [f"# TYPE {metric} {kind}", f"{metric} {stats[name]}"]
+    return lines
+
+metrics.collectors.append(response_cache_metrics)
+
+# ---------- Content-Encoding negotiation ----------
+def choose_encoding(accept_encoding):
+    """Pick "br" or "gzip" from an Accept-Encoding header (honouring q=0), or None."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in (("br", "gzip") if brotli else ("gzip",)):
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # mtime=0 keeps the output (and so its ETag) identical across renders
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+class StreamCompressor:
+    """Incremental br/gzip encoder; every compress() call returns bytes that can be sent now."""
+    def __init__(self, encoding):
+        if encoding == "br":
+            self.encoder = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress = lambda data: self.encoder.process(data) + self.encoder.flush()
+            self.finish = self.encoder.finish
+        else:
+            self.encoder = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 = gzip container
+            self.compress = lambda data: self.encoder.compress(data) + self.encoder.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = self.encoder.flush
+
+# (absolute path, encoding) -> (mtime_ns, size, compressed bytes), least recently used
+# first; beyond STATIC_VARIANTS_MAX_BYTES of compressed bytes the oldest are dropped.
+static_variants=OrderedDict()
+static_variants_size=0
+static_variants_lock=threading.Lock()
+
+def get_static_variant(path, st, encoding):
+    """Compressed copy of a static file, compressed once per file version."""
+    global static_variants_size
+    key = (path, encoding)
+    with static_variants_lock:
+        variant = static_variants.get(key)
+        if variant is not None:
+            static_variants.move_to_end(key)
+    if variant is None or variant[:2] != (st.st_mtime_ns, st.st_size):
+        with open(path, "rb") as f:
+            data = compress(f.read(), encoding)
+        variant = (st.st_mtime_ns, st.st_size, data)
+        with static_variants_lock:
+            old = static_variants.pop(key, None)
+            if old is not None:
+                static_variants_size -= len(old[2])
+            static_variants[key] = variant
+            static_variants_size += len(data)
+            while static_variants_size > STATIC_VARIANTS_MAX_BYTES:
+                static_variants_size -= len(static_variants.popitem(last=False)[1][2])
+    return variant[2]
+
+def make_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value matches etag (weak comparison, as RFC 9110 asks)."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host.removeprefix("::ffff:")).is_loopback
+    except ValueError:
+        return False
+
 class MyRequestHandler(http.server.SimpleHTTPRequestHandler):
     pages={}
-    def do_GET(self):
+    # HTTP/1.1 lets browsers reuse one connection for the page and its images.
+    protocol_version="HTTP/1.1"
+    timeout=KEEP_ALIVE_TIMEOUT
+    # Headers and body are separate writes; without TCP_NODELAY a kept-alive
+    # connection stalls ~40 ms on Nagle + delayed ACK for small responses.
+    disable_nagle_algorithm=True
+    def do_GET(self, head_only=False):
+        started = time.perf_counter()
+        self.head_only = head_only
         parsed_url = urlparse(self.path)
-        debugging_helper(f"A web browser wants to GET the following: {parsed_url.path}")
-        if parsed_url.path in MyRequestHandler.pages:
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-
-            query = parsed_url.query
-            form_data = parse_qs(query)
-            debugging_helper(f"\tReceived following data with GET request: {form_data}")
-            
-            html_content = MyRequestHandler.pages[parsed_url.path].get_page_html(form_data)
-            
-            self.wfile.write(html_content.encode('utf-8'))            
-        else:
-            # Let the server handle static files (like images, .html files)
-            super().do_GET()
-            
+        logger.debug("GET path=%s", parsed_url.path)
+        route = parsed_url.path if parsed_url.path in MyRequestHandler.pages else "static"
+        # Per-phase timings for this request; get_results_from_query() adds "db" time to it.
+        self.timing = {}
+        set_request_timing(self.timing)
+        self.status = None
+        metrics.request_started(route)
+        try:
+            if route != "static":
+                query = parsed_url.query
+                form_data = parse_qs(query)
+                logger.debug("GET form_data=%s", form_data)
+                self.timing["parse"] = time.perf_counter() - started
+                self.serve_page(route, form_data)
+            else:
+                # Static files (CSS, images, ...) come from the in-memory asset cache or sendfile()
+                self.send_page_response(static_response(self.path, self.directory, self.headers))
+        finally:
+            set_request_timing(None)
+            metrics.request_finished(route, self.status or 500, time.perf_counter() - started, self.timing)
+
+    def do_HEAD(self):
+        self.do_GET(head_only=True)
+
+    def handle(self):
+        # Like BaseHTTPRequestHandler.handle(), but a connection with no request in
+        # progress gives its worker up as soon as another connection is queued for one.
+        self.close_connection = True
+        while self.wait_for_request():
+            self.handle_one_request()
+            if self.close_connection:
+                break
+
+    def wait_for_request(self):
+        """Wait up to KEEP_ALIVE_TIMEOUT for the next request's first bytes; False to close the connection."""
+        # A pipelined request may already be buffered, where the selector cannot see it
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        idle_since = time.monotonic()
+        give_way = getattr(self.server, "give_way", None)
+        # Not select.select(): it fails for descriptors past FD_SETSIZE (1024), which a busy server reaches
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.connection, selectors.EVENT_READ)
+            while True:
+                idle = time.monotonic() - idle_since
+                remaining = KEEP_ALIVE_TIMEOUT - idle
+                if remaining <= 0:
+                    return False
+                if give_way is not None and idle >= IDLE_GIVE_WAY_AFTER and give_way(self.request):
+                    return False
+                if selector.select(min(IDLE_POLL_INTERVAL, remaining)):
+                    return True
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def timed_write(self, data):
+        t0 = time.perf_counter()
+        self.wfile.write(data)
+        self.timing["write"] = self.timing.get("write", 0.0) + time.perf_counter() - t0
+
+    def log_message(self, format, *args):
+        # Access log goes through the queued logger instead of a blocking stderr write.
+        access_logger.info("%s %s", self.address_string(), format % args)
+
+    def serve_page(self, route, form_data):
+        client_host = self.client_address[0]
+        response = cached_page_response(route, form_data, self.headers, client_host, self.timing)
+        if response is None:
+            response = admit_page(route, form_data, client_host)
+        if response is not None:
+            self.send_page_response(response)
+            return
+        try:
+            response = build_page_response(route, form_data, self.headers, client_host, self.timing,
+                                           chunked=self.request_version == "HTTP/1.1", lookup=False)
+            # A streamed page is rendered while it is sent: it holds its slot until the end.
+            self.send_page_response(response)
+        finally:
+            finish_page(route)
+
+    def send_page_response(self, response):
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if isinstance(response, FileResponse):
+            with response.file:
+                if not self.head_only:
+                    t0 = time.perf_counter()
+                    # Zero-copy: the kernel moves the bytes from the page cache to the socket.
+                    self.connection.sendfile(response.file, response.offset, response.count)
+                    self.timing["write"] = self.timing.get("write", 0.0) + time.perf_counter() - t0
+            return
+        if response.chunks is None:
+            if response.body and not self.head_only:
+                self.timed_write(response.body)
+            return
+        for data in response.chunks:
+            if not self.head_only:
+                self.write_chunk(data)
+        if not self.head_only:
+            self.timed_write(b"0\r\n\r\n")
+
+    def write_chunk(self, data):
+        if data:
+            self.timed_write(b"%x\r\n%s\r\n" % (len(data), data))
+
+
+# ---------- Responses (shared by the threaded server above and async_server.py) ----------
+class PageResponse:
+    """Status, headers and either a whole body or an iterator of encoded body chunks."""
+    __slots__ = ("status", "headers", "body", "chunks")
+    def __init__(self, status, headers, body=b"", chunks=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.chunks = chunks
+
+def error_response(status, message):
+    body = f"<!DOCTYPE html><html><body><h1>{status}</h1><p>{message}</p></body></html>".encode("utf-8")
+    return PageResponse(status, [("Content-type", "text/html; charset=utf-8"),
+                                 ("Content-Length", str(len(body)))], body)
+
+def page_cache_key(route, form_data, request_headers):
+    """(page, cache key, database version, encoding) for a page request."""
+    page = MyRequestHandler.pages[route]
+    # Pages opt out of caching with `cacheable = False`; otherwise they are cached
+    # until the database they read (their DB_PATH) changes.
+    database = getattr(page, "DB_PATH", None)
+    encoding = choose_encoding(request_headers.get("Accept-Encoding"))
+    # Each content-encoding is cached as its own representation with its own ETag.
+    key = (route, normalize_form_data(form_data), encoding)
+    version = database_version(database) if database else None
+    return page, key, version, encoding
+
+def cached_page_response(route, form_data, request_headers, client_host, timing):
+    """
+    The response for a page request that needs no rendering (a cache hit, or a 403
+    for a local_only page), else None. Cheap enough to call on an event loop.
+    """
+    page, key, version, encoding = page_cache_key(route, form_data, request_headers)
+    # Diagnostics pages set `local_only = True` and are only served to this machine.
+    if getattr(page, "local_only", False) and not is_loopback(client_host):
+        return error_response(403, "Forbidden")
+    if not getattr(page, "cacheable", True):
+        return None
+    t0 = time.perf_counter()
+    cached = response_cache.get(key, version)
+    timing["cache"] = time.perf_counter() - t0
+    if cached is None:
+        return None
+    # Pages may serve something other than HTML (e.g. `content_type = "text/plain"`).
+    content_type = getattr(page, "content_type", "text/html")
+    return page_response(*cached, content_type, "HIT", request_headers.get("If-None-Match"), timing)
+
+def admit_page(route, form_data, client_host):
+    """
+    Admission control for a page request that needs rendering (call after
+    cached_page_response()). None if it may go ahead, and finish_page(route) must
+    be called once it is done; otherwise the 429/503 response to send instead.
+    """
+    page = MyRequestHandler.pages[route]
+    # Expensive pages set `rate_limited = True`, or a function of form_data saying which requests are
+    rate_limited = getattr(page, "rate_limited", False)
+    if callable(rate_limited):
+        rate_limited = rate_limited(form_data)
+    if rate_limited and RATE_LIMIT:
+        wait = admission.clients.acquire(client_host, *RATE_LIMIT)
+        if wait:
+            admission.rejected("rate")
+            return overload_response(429, "Too many requests", wait)
+    if not admission.pages.try_acquire(route, MAX_CONCURRENT_PAGES, ROUTE_CONCURRENCY.get(route)):
+        admission.rejected("concurrency")
+        return overload_response(503, "Server busy", RETRY_AFTER)
+    return None
+
+def finish_page(route):
+    admission.pages.release(route)
+
+def overload_response(status, message, retry_after):
+    response = error_response(status, message + ", please try again shortly.")
+    response.headers += [("Retry-After", str(max(1, math.ceil(retry_after)))), ("Cache-Control", "no-store")]
+    return response
+
+def raw_response(response):
+    """A whole HTTP/1.1 response as bytes, for answering without a request handler."""
+    lines = [f"HTTP/1.1 {response.status} {http.client.responses.get(response.status, '')}"]
+    lines += [f"{name}: {value}" for name, value in response.headers]
+    lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1") + response.body
+
+def build_page_response(route, form_data, request_headers, client_host, timing, chunked=True, lookup=True):
+    """
+    Render (or fetch from the response cache) the page registered for route.
+    Pages that return a generator are streamed: the response's chunks are already
+    compressed and must be sent with Transfer-Encoding: chunked. chunked=False
+    (HTTP/1.0 clients) joins them into one body instead. lookup=False skips
+    cached_page_response() when the caller has already tried it.
+    """
+    if lookup:
+        response = cached_page_response(route, form_data, request_headers, client_host, timing)
+        if response is not None:
+            return response
+    page, key, version, encoding = page_cache_key(route, form_data, request_headers)
+    cacheable = getattr(page, "cacheable", True)
+    content_type = getattr(page, "content_type", "text/html")
+    if_none_match = request_headers.get("If-None-Match")
+
+    t0 = time.perf_counter()
+    html_content = page.get_page_html(form_data)
+    if isinstance(html_content, bytes):
+        # Pre-encoded output, e.g. from templates.Template.render()
+        body = html_content
+    elif isinstance(html_content, str):
+        body = html_content.encode('utf-8')
+    elif not chunked:
+        # Chunked transfer encoding needs HTTP/1.1; older clients get the joined page.
+        body = b"".join(encode_chunks(html_content))
+    else:
+        # get_page_html() returned a generator of HTML chunks: stream it as it is produced.
+        def cache_streamed(body):
+            response_cache.put(key, version, make_etag(body), body, encoding)
+        headers = [("Content-type", content_type), ("Transfer-Encoding", "chunked")]
+        if encoding:
+            headers.append(("Content-Encoding", encoding))
+        headers += [
+            ("Vary", "Accept-Encoding"),
+            ("Cache-Control", "no-cache"),
+            ("X-Cache", "MISS"),
+            # Only the phases finished before the first byte are known here; /metrics has the rest.
+            ("Server-Timing", metrics.server_timing(timing)),
+        ]
+        chunks = stream_chunks(html_content, encoding, timing, t0, cache_streamed if cacheable else None)
+        return PageResponse(200, headers, chunks=chunks)
+    timing["render"] = time.perf_counter() - t0 - timing.get("db", 0.0)
+
+    if encoding and len(body) >= COMPRESS_MIN_SIZE:
+        t0 = time.perf_counter()
+        body = compress(body, encoding)
+        timing["compress"] = time.perf_counter() - t0
+    else:
+        encoding = None
+    etag = make_etag(body)
+    if cacheable:
+        response_cache.put(key, version, etag, body, encoding)
+    return page_response(etag, body, encoding, content_type, "MISS", if_none_match, timing)
+
+def page_response(etag, body, encoding, content_type, cache_status, if_none_match, timing):
+    if etag_matches(if_none_match, etag):
+        return PageResponse(304, [("ETag", etag), ("Cache-Control", "no-cache")])
+    # Content-Length is required so the connection can be kept alive.
+    headers = [("Content-type", content_type), ("Content-Length", str(len(body)))]
+    if encoding:
+        headers.append(("Content-Encoding", encoding))
+    headers += [
+        ("Vary", "Accept-Encoding"),
+        ("ETag", etag),
+        # Browsers keep the page but revalidate it, which is answered with a 304.
+        ("Cache-Control", "no-cache"),
+        ("X-Cache", cache_status),
+        ("Server-Timing", metrics.server_timing(timing)),
+    ]
+    return PageResponse(200, headers, body)
+
+def stream_chunks(chunks, encoding, timing, started, on_complete=None):
+    """
+    Yield a page generator's output as ~STREAM_CHUNK_SIZE pieces, compressed if encoding
+    is set. If on_complete is given and the whole (encoded) body fits in the response
+    cache, it is called with that body once the stream has been sent.
+    """
+    compressor = StreamCompressor(encoding) if encoding else None
+    kept = [] if on_complete else None
+    kept_size = 0
+    pending = []
+    pending_size = 0
+
+    def encode(data):
+        if compressor:
+            t0 = time.perf_counter()
+            data = compressor.compress(data)
+            timing["compress"] = timing.get("compress", 0.0) + time.perf_counter() - t0
+        return data
+
+    try:
+        for data in encode_chunks(chunks):
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size < STREAM_CHUNK_SIZE:
+                continue
+            data = encode(b"".join(pending))
+            pending, pending_size = [], 0
+            if not data:
+                continue
+            if kept is not None:
+                kept.append(data)
+                kept_size += len(data)
+                if kept_size > response_cache.max_bytes // 8:
+                    kept = None
+            yield data
+        tail = encode(b"".join(pending)) if pending else b""
+        if compressor:
+            tail += compressor.finish()
+        if tail:
+            if kept is not None:
+                kept.append(tail)
+            yield tail
+    finally:
+        # Rendering and streamed cursor reads interleave with the writes: split them afterwards.
+        timing["render"] = (time.perf_counter() - started - timing.get("db", 0.0)
+                            - timing.get("write", 0.0) - timing.get("compress", 0.0))
+    if kept is not None:
+        on_complete(b"".join(kept))
+
+# ---------- Static files ----------
+def translate_path(path, directory):
+    """File system path under directory for a URL path (like SimpleHTTPRequestHandler's)."""
+    path = urlparse(path).path
+    trailing_slash = path.endswith("/")
+    path = posixpath.normpath(unquote(path, errors="surrogatepass"))
+    parts = [part for part in path.split("/") if part and part not in (os.curdir, os.pardir)]
+    path = os.path.join(directory, *parts)
+    if trailing_slash:
+        path += "/"
+    return path
+
+@functools.lru_cache(maxsize=1024)
+def static_path(url_path, directory):
+    """translate_path() for the path part of a static URL, remembered for repeat requests."""
+    return translate_path(url_path, directory)
+
+def static_cache_control(url):
+    if "v=" in urlparse(url).query:
+        return f"public, max-age={STATIC_VERSIONED_MAX_AGE}, immutable"
+    return f"public, max-age={STATIC_MAX_AGE}"
+
+class FileResponse(PageResponse):
+    """A response whose body is count bytes of an open file from offset, sent with sendfile()."""
+    __slots__ = ("file", "offset", "count")
+    def __init__(self, status, headers, file, offset, count):
+        super().__init__(status, headers)
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+def not_modified(request_headers, etag, mtime):
+    """True if the request's If-None-Match (or, without one, If-Modified-Since) allows a 304."""
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = request_headers.get("If-Modified-Since")
+    if not since:
+        return False
+    try:
+        return int(mtime) <= email.utils.parsedate_to_datetime(since).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return False
+
+def parse_range(range_header, size):
+    """
+    (start, stop) for a single "bytes=" range of a size-byte body, False if it is
+    unsatisfiable, or None to ignore the header (other units, several ranges,
+    bad syntax) and send the whole body, as RFC 9110 allows.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # "-N": the last N bytes
+        if not last:
+            return None
+        if int(last) == 0 or size == 0:
+            return False
+        return max(0, size - int(last)), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    end = int(last) if last else size - 1
+    return start, min(end, size - 1) + 1
+
+def static_plan(request_headers, size, etag, mtime, last_modified):
+    """(status, byte range or None) for a GET of a static file: 304, 416, 206 or 200."""
+    if not_modified(request_headers, etag, mtime):
+        return 304, None
+    range_header = request_headers.get("Range")
+    if range_header is not None:
+        # If-Range: only send the part if the client's copy is still current
+        if_range = request_headers.get("If-Range")
+        if if_range is None or if_range.strip() in (etag, last_modified):
+            byte_range = parse_range(range_header, size)
+            if byte_range is False:
+                return 416, None
+            if byte_range is not None:
+                return 206, byte_range
+    return 200, None
+
+def static_headers(status, content_type, size, byte_range, encoding, etag, last_modified, vary, url):
+    headers = []
+    if status == 416:
+        headers += [("Content-Range", f"bytes */{size}"), ("Content-Length", "0")]
+    elif status != 304:
+        start, stop = byte_range or (0, size)
+        headers += [("Content-type", content_type), ("Content-Length", str(stop - start))]
+        if status == 206:
+            headers.append(("Content-Range", f"bytes {start}-{stop - 1}/{size}"))
+        # Ranges are only served from the uncompressed file
+        headers.append(("Content-Encoding", encoding) if encoding else ("Accept-Ranges", "bytes"))
+    headers += [("ETag", etag), ("Last-Modified", last_modified)]
+    if vary:
+        headers.append(("Vary", "Accept-Encoding"))
+    headers.append(("Cache-Control", static_cache_control(url)))
+    return headers
+
+class StaticAsset:
+    """A small static file held in memory with its compressed variants and ready-made responses."""
+    __slots__ = ("key", "body", "content_type", "mtime", "last_modified", "etag", "variants",
+                 "responses", "nbytes", "checked")
+    def __init__(self, key, body, content_type, mtime):
+        self.key = key          # (inode, mtime_ns, size) of the file read
+        self.body = body
+        self.content_type = content_type
+        self.mtime = mtime
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        # A hash of the content: strong, and the same in every server process
+        self.etag = make_etag(body)
+        self.variants = {}      # encoding -> (compressed body, etag)
+        if content_type in COMPRESSIBLE_TYPES and len(body) >= COMPRESS_MIN_SIZE:
+            for encoding in (("br", "gzip") if brotli else ("gzip",)):
+                self.variants[encoding] = (compress(body, encoding), f'{self.etag[:-1]}-{encoding}"')
+        self.nbytes = len(body) + sum(len(variant) for variant, _ in self.variants.values())
+        self.responses = {}     # (encoding, versioned url, status) -> PageResponse
+        self.checked = time.monotonic()
+
+    def response(self, url, request_headers):
+        encoding = None
+        if self.variants and "Range" not in request_headers:
+            encoding = choose_encoding(request_headers.get("Accept-Encoding"))
+        body, etag = self.variants[encoding] if encoding else (self.body, self.etag)
+        status, byte_range = static_plan(request_headers, len(body), etag, self.mtime, self.last_modified)
+        if status == 206:
+            start, stop = byte_range
+            return PageResponse(206, static_headers(206, self.content_type, len(body), byte_range, None, etag,
+                                                    self.last_modified, bool(self.variants), url),
+                                body[start:stop])
+        # Everything else is one of a few fixed responses, built once
+        key = (encoding, "v=" in url.partition("?")[2], status)
+        response = self.responses.get(key)
+        if response is None:
+            headers = static_headers(status, self.content_type, len(body), None, encoding, etag,
+                                     self.last_modified, bool(self.variants), url)
+            response = self.responses[key] = PageResponse(status, headers, body if status == 200 else b"")
+        return response
+
+class StaticCache:
+    """StaticAssets by file system path; the oldest are dropped beyond max_bytes."""
+    def __init__(self, max_bytes=STATIC_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.assets = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        return self.assets.get(path)
+
+    def put(self, path, asset):
+        # A single file may use at most an eighth of the cache.
+        if asset.nbytes > self.max_bytes // 8:
+            return
+        with self.lock:
+            self._remove(path)
+            self.assets[path] = asset
+            self.size += asset.nbytes
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.assets)))
+
+    def discard(self, path):
+        with self.lock:
+            self._remove(path)
+
+    def _remove(self, path):
+        asset = self.assets.pop(path, None)
+        if asset is not None:
+            self.size -= asset.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.assets.clear()
+            self.size = 0
+
+static_cache=StaticCache()
+
+def static_cache_metrics():
+    return ["# TYPE pyhtml_static_cache_entries gauge", f"pyhtml_static_cache_entries {len(static_cache.assets)}",
+            "# TYPE pyhtml_static_cache_bytes gauge", f"pyhtml_static_cache_bytes {static_cache.size}"]
+
+metrics.collectors.append(static_cache_metrics)
+
+def load_static_asset(path, asset=None):
+    """The StaticAsset for path, re-read if the file has changed; None unless it is a small regular file."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode) or st.st_size > STATIC_CACHE_FILE_MAX_SIZE:
+        if asset is not None:
+            static_cache.discard(path)
+        return None
+    if asset is not None and asset.key == (st.st_ino, st.st_mtime_ns, st.st_size):
+        asset.checked = time.monotonic()
+        return asset
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        body = f.read(STATIC_CACHE_FILE_MAX_SIZE + 1)
+    if len(body) != st.st_size:
+        # Being written right now: send it from disk this time
+        return None
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    asset = StaticAsset((st.st_ino, st.st_mtime_ns, st.st_size), body, content_type, st.st_mtime)
+    static_cache.put(path, asset)
+    return asset
+
+def file_response(path, url, request_headers):
+    """Response for a static file too big to keep in memory: sent from disk with sendfile()."""
+    try:
+        f = open(path, "rb")
+    except OSError:
+        # Missing, or a directory: there are no directory listings
+        return error_response(404, "File not found")
+    try:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            f.close()
+            return error_response(404, "File not found")
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        vary = content_type in COMPRESSIBLE_TYPES and COMPRESS_MIN_SIZE <= st.st_size <= STATIC_COMPRESS_MAX_SIZE
+        encoding = choose_encoding(request_headers.get("Accept-Encoding")) if vary else None
+        if encoding and "Range" not in request_headers:
+            f.close()
+            body = get_static_variant(path, st, encoding)
+            etag = f'{etag[:-1]}-{encoding}"'
+            status, _ = static_plan(request_headers, len(body), etag, st.st_mtime, last_modified)
+            headers = static_headers(status, content_type, len(body), None, encoding, etag, last_modified, vary, url)
+            return PageResponse(status, headers, body if status == 200 else b"")
+        status, byte_range = static_plan(request_headers, st.st_size, etag, st.st_mtime, last_modified)
+        headers = static_headers(status, content_type, st.st_size, byte_range, None, etag, last_modified, vary, url)
+        if status not in (200, 206):
+            f.close()
+            return PageResponse(status, headers)
+        start, stop = byte_range or (0, st.st_size)
+        return FileResponse(status, headers, f, start, stop - start)
+    except BaseException:
+        f.close()
+        raise
+
+def static_response(url, directory, request_headers):
+    """
+    Response for a static file under directory. Small files are answered from
+    memory (re-checked on disk every STATIC_CHECK_INTERVAL seconds), larger ones
+    with a FileResponse that the server sends with sendfile().
+    """
+    path = static_path(url.partition("?")[0], directory)
+    asset = static_cache.get(path)
+    if asset is None or time.monotonic() - asset.checked >= STATIC_CHECK_INTERVAL:
+        asset = load_static_asset(path, asset)
+        if asset is None:
+            return file_response(path, url, request_headers)
+    return asset.response(url, request_headers)
+
+def cached_static_response(url, directory, request_headers):
+    """static_response() if the file is in memory and recently checked, else None. Never touches the disk."""
+    asset = static_cache.get(static_path(url.partition("?")[0], directory))
+    if asset is None or time.monotonic() - asset.checked >= STATIC_CHECK_INTERVAL:
+        return None
+    return asset.response(url, request_headers)
+
+
+def encode_chunks(chunks):
+    """Yield the non-empty pieces of a page generator as UTF-8 bytes."""
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if chunk:
+            yield chunk
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """
+    HTTP server that hands every accepted connection to a fixed-size pool of
+    worker threads, so one slow page no longer blocks every other visitor.
+    """
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS, sock=None):
+        self.workers = max(1, int(workers))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pyhtml-worker")
+        # Connections handed to the pool and not finished yet (being served or waiting)
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.gave_way = set()     # connections already uncounted by give_way()
+        if sock is None:
+            super().__init__(server_address, handler_class)
+            return
+        # Serve on an already listening socket (a prefork worker's inherited one)
+        super().__init__(sock.getsockname()[:2], handler_class, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+
+    def process_request(self, request, client_address):
+        # The accept queue is bounded: past ACCEPT_QUEUE_SIZE waiting connections, answer 503 now
+        with self.pending_lock:
+            if self.pending >= self.workers + ACCEPT_QUEUE_SIZE:
+                full = True
+            else:
+                full = False
+                self.pending += 1
+        if full:
+            admission.rejected("queue_full")
+            self.reject(request)
+            self.shutdown_request(request)
+            return
+        self.executor.submit(self.process_request_worker, request, client_address, time.monotonic())
+
+    def give_way(self, request):
+        """
+        Called by an idle connection's handler: True if a connection is queued for a
+        worker, and request (now counted as finished) should close to make way for it.
+        One queued connection only ever makes one idle connection close.
+        """
+        with self.pending_lock:
+            if self.pending <= self.workers:
+                return False
+            self.pending -= 1
+            self.gave_way.add(request)
+            return True
+
+    def process_request_worker(self, request, client_address, queued_at):
+        try:
+            if time.monotonic() - queued_at > ACCEPT_QUEUE_TIMEOUT:
+                # Served this late, the client has probably given up: free the worker instead
+                admission.rejected("queue_timeout")
+                self.reject(request)
+            else:
+                self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.pending_lock:
+                if request in self.gave_way:
+                    self.gave_way.discard(request)
+                else:
+                    self.pending -= 1
+            self.shutdown_request(request)
+
+    def reject(self, request):
+        """Send a canned 503 on a connection without reading its request, then close it."""
+        try:
+            # Take whatever request bytes have arrived, so closing does not reset the connection
+            request.setblocking(False)
+            try:
+                request.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                pass
+            request.setblocking(True)
+            request.settimeout(1.0)
+            request.sendall(raw_response(overload_response(503, "Server busy", RETRY_AFTER)))
+        except OSError:
+            pass
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def host_site(port=80, workers=DEFAULT_WORKERS, server=None, processes=None, in_memory=None):
+    # in_memory=True serves the pages' queries from in-memory copies of their databases
+    if IN_MEMORY if in_memory is None else in_memory:
+        for database in sorted({page.DB_PATH for page in MyRequestHandler.pages.values()
+                                if getattr(page, "DB_PATH", None)}):
+            size = use_memory_copy(database)
+            print(f"Serving {os.path.basename(database)} from memory ({size / 2**20:.1f} MB)")
+    # processes > 1 forks that many server processes sharing the port (see prefork.py)
+    processes = PROCESSES if processes is None else processes
+    if processes > 1:
+        import prefork
+        return prefork.host_site(port, processes, workers, server)
+    # server="asyncio" runs the event-loop server in async_server.py instead of threads
+    if (server or SERVER_MODE) == "asyncio":
+        import async_server
+        return async_server.host_site(port, workers)
 
-def host_site():
     # Set the port
-    PORT = 80
+    PORT = port
 
-    # Create the HTTP server
-    with socketserver.TCPServer(("", PORT), MyRequestHandler) as httpd:
+    configure_logging()
+
+    # Create the HTTP server (workers=1 serves one connection at a time, like the original server)
+    with PooledHTTPServer(("", PORT), MyRequestHandler, workers=workers) as httpd:
         print("Using your favourite browser, go to:\n")
         if (PORT==80):
             print("http://localhost")
         print(f"or\nhttp://localhost:{PORT}\n")
-        httpd.serve_forever()
+        print(f"Serving with {httpd.workers} worker thread(s)\n")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop_logging()
         
         
-def get_results_from_query(database,query):
-    debugging_helper("\n------------------------")
-    debugging_helper("Opening database \""+database+"\"... ")
-    connection = sqlite3.connect(database)
+# ---------- SQLite connection pool ----------
+# Each worker thread keeps one open connection per database file, so connection
+# setup, schema parsing and statement preparation are paid once per thread
+# instead of once per query.
+_thread_local = threading.local()
+
+def open_connection(database):
+    """Open a read-only connection to database with the pool's pragmas applied."""
+    if database in _memory_databases:
+        uri = memory_copy(database).uri
+    else:
+        uri = "file:" + pathname2url(os.path.abspath(database)) + "?mode=ro"
+    connection = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+    for name, value in SQLITE_PRAGMAS.items():
+        connection.execute(f"PRAGMA {name}={value}")
+    return connection
+
+# ---------- In-memory copies ----------
+# use_memory_copy(database) makes the pool open connections to a shared-cache
+# in-memory copy of the file instead of the file itself. The copy is made with
+# the backup API and replaced by a fresh one (under a new name) when the file's
+# database_version() changes: connections are reopened on the new copy as they
+# come back to the pool, and the old copy is freed once the last one has gone.
+_memory_databases = set()   # databases to serve from memory
+_memory_copies = {}         # database -> MemoryCopy
+_memory_lock = threading.Lock()
+_memory_generation = 0
+
+class MemoryCopy:
+    __slots__ = ("uri", "version", "size", "keeper")
+    def __init__(self, database, version):
+        global _memory_generation
+        _memory_generation += 1
+        name = f"{os.path.basename(database)}-{os.getpid()}-{_memory_generation}"
+        self.uri = f"file:{name}?mode=memory&cache=shared"
+        self.version = version
+        # A shared in-memory database lives as long as a connection to it is open.
+        self.keeper = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        source = sqlite3.connect("file:" + pathname2url(os.path.abspath(database)) + "?mode=ro", uri=True)
+        try:
+            source.backup(self.keeper)
+        finally:
+            source.close()
+        page_size, = self.keeper.execute("PRAGMA page_size").fetchone()
+        page_count, = self.keeper.execute("PRAGMA page_count").fetchone()
+        self.size = page_size * page_count
+
+def memory_copy(database):
+    """The current MemoryCopy of database, (re)loaded if the file has changed."""
+    version = database_version(database)
+    copy = _memory_copies.get(database)
+    if copy is not None and copy.version == version:
+        return copy
+    with _memory_lock:
+        copy = _memory_copies.get(database)
+        if copy is None or copy.version != version:
+            started = time.perf_counter()
+            new = MemoryCopy(database, version)
+            _memory_copies[database] = new
+            logger.info("loaded %s into memory: %.1f MB in %.0f ms", database,
+                        new.size / 2**20, (time.perf_counter() - started) * 1000)
+            if copy is not None:
+                # Pooled connections still on the old copy keep it alive until they reconnect.
+                copy.keeper.close()
+            copy = new
+    return copy
+
+def use_memory_copy(database):
+    """Serve database from an in-memory copy from now on; returns its size in bytes."""
+    _memory_databases.add(database)
+    return memory_copy(database).size
+
+def _reset_after_fork():
+    """
+    In a forked child: start with no pooled connections and no log writer thread.
+    The parent's SQLite connections must not be used (or closed) here, so they are
+    only kept referenced; the parent's log queue belongs to a thread that did not fork.
+    """
+    global _thread_local, _log_listener, _memory_lock
+    _inherited.append(_thread_local)
+    _thread_local = threading.local()
+    # In-memory copies are per process: the child loads its own on first use.
+    _inherited.append(dict(_memory_copies))
+    _memory_copies.clear()
+    _memory_lock = threading.Lock()
+    for handler in list(logger.handlers):
+        if isinstance(handler, DroppingQueueHandler):
+            logger.removeHandler(handler)
+    _log_listener = None
+
+_inherited = []
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_connection(database):
+    """
+    Return this thread's pooled connection to database, opening it on first use.
+    If the file has been replaced since (e.g. by `ingest.py load`, which swaps in a
+    new file), or its in-memory copy reloaded, a new connection is opened; one still
+    in a read transaction keeps its snapshot until the transaction ends.
+    """
+    connections = getattr(_thread_local, "connections", None)
+    if connections is None:
+        connections = _thread_local.connections = {}
+    if database in _memory_databases:
+        source = memory_copy(database).uri
+    else:
+        try:
+            source = os.stat(database).st_ino
+        except OSError:
+            source = None
+    entry = connections.get(database)
+    if entry is not None and entry[1] != source and not entry[0].in_transaction:
+        logger.info("database %s was replaced; reconnecting", database)
+        # Not closed here: a cursor still being streamed keeps the old connection alive.
+        entry = None
+    if entry is None:
+        logger.debug("opening database %s", database)
+        entry = connections[database] = (open_connection(database), source)
+    return entry[0]
+
+def close_connections():
+    """Close every pooled connection owned by the calling thread."""
+    connections = getattr(_thread_local, "connections", None) or {}
+    for connection, _ in connections.values():
+        connection.close()
+    connections.clear()
+
+def set_request_timing(timing):
+    """Make timing (a {phase: seconds} dict) the current request's on this thread, or clear it."""
+    _thread_local.timing = timing
+
+def add_db_time(seconds):
+    """Charge seconds of SQLite work to the current request's "db" phase (if any)."""
+    timing = getattr(_thread_local, "timing", None)
+    if timing is not None:
+        timing["db"] = timing.get("db", 0.0) + seconds
+
+def get_results_from_query(database,query,params=()):
+    start = time.perf_counter()
+    connection=get_connection(database)
     cursor=connection.cursor()
-    debugging_helper("done\n")
-    debugging_helper("Executing query \""+query+"\"... ")
-    cursor.execute(query)
-    debugging_helper("done\n")
-    debugging_helper("Fetching results...\n")
+    cursor.execute(query, params)
     results = cursor.fetchall();
-    debugging_helper(results)
-    debugging_helper("\n------------------------")
+    elapsed = time.perf_counter() - start
+    add_db_time(elapsed)
+    query_profiler.record(connection, database, query, params, elapsed, len(results))
+    if logger.isEnabledFor(logging.DEBUG):
+        elapsed_ms = elapsed * 1000
+        if LOG_RESULT_SAMPLE_RATE >= 1 or random.random() < LOG_RESULT_SAMPLE_RATE:
+            logger.debug("query rows=%d ms=%.2f sql=%s params=%r results=%s",
+                         len(results), elapsed_ms, CompactSQL(query), params, ResultPreview(results))
+        else:
+            logger.debug("query rows=%d ms=%.2f sql=%s params=%r",
+                         len(results), elapsed_ms, CompactSQL(query), params)
     return results
 
+# ---------- Lazy, batched results ----------
+# get_results_from_query() returns the whole result as a list. The functions below
+# read it FETCH_BATCH_SIZE rows at a time instead, so a request only ever holds one
+# batch, and rows can be rendered while the query is still running:
+#
+#     for row in pyhtml.iter_rows(DB_PATH, "SELECT name, region FROM Country"):
+#         row.name, row.region      # or row[0], row[1]: rows are still tuples
+#
+# named=True rows are namedtuples (tuple subclasses, so no per-row __dict__) of the
+# query's column names; unusable names (e.g. COUNT(*)) become _0, _1, ... . A caller
+# that stops early (a page that breaks out of the loop) just drops the iterator;
+# the cursor is closed when it is garbage collected.
+
+@functools.lru_cache(maxsize=256)
+def row_class(columns):
+    """Row namedtuple class for a tuple of column names."""
+    return namedtuple("Row", columns, rename=True)
+
+def iter_batches(database,query,params=(),batch_size=None,named=True,connection=None):
+    """
+    Yield the result of query as lists of up to batch_size (FETCH_BATCH_SIZE) rows.
+    connection defaults to this thread's pooled connection to database.
+    """
+    batch_size = batch_size or FETCH_BATCH_SIZE
+    connection = connection or get_connection(database)
+    start = time.perf_counter()
+    cursor = connection.execute(query, params)
+    elapsed = time.perf_counter() - start
+    make = row_class(tuple(d[0] for d in cursor.description or ()))._make if named else None
+    rows = 0
+    try:
+        while True:
+            t0 = time.perf_counter()
+            batch = cursor.fetchmany(batch_size)
+            elapsed += time.perf_counter() - t0
+            if not batch:
+                break
+            rows += len(batch)
+            yield list(map(make, batch)) if make else batch
+    finally:
+        # Only time spent inside SQLite counts, not the caller's work between batches.
+        cursor.close()
+        add_db_time(elapsed)
+        query_profiler.record(connection, database, query, params, elapsed, rows)
+        # The batches are gone by now, so unlike get_results_from_query there is no results preview.
+        logger.debug("query rows=%d ms=%.2f sql=%s params=%r", rows, elapsed * 1000, CompactSQL(query), params)
+
+def iter_rows(database,query,params=(),batch_size=None,named=True):
+    """Yield the rows of query one at a time (fetched in batches, see iter_batches)."""
+    batches = iter_batches(database, query, params, batch_size, named)
+    try:
+        for batch in batches:
+            yield from batch
+    finally:
+        batches.close()
+
+def iter_results_from_query(database,query,params=(),batch_size=None):
+    """Like get_results_from_query, but rows (plain tuples) are produced lazily; see iter_rows."""
+    return iter_rows(database, query, params, batch_size, named=False)
+
+# ---------- Request-scoped queries ----------
+class QueryContext:
+    """
+    The queries of one page request against one database. They run on one of the
+    thread's pooled connections inside a single read transaction, so they all see
+    the same snapshot of the data, and a statement repeated with the same parameters is
+    answered from the first run's rows (if it had at most QUERY_MEMO_MAX_ROWS)
+    instead of being executed again.
+
+        q = pyhtml.QueryContext(DB_PATH)
+        with q:
+            for row in q.iter_rows(sql, params): ...
+            q.rows(sql, params)          # same statement: no second query
+
+    A streamed page enters the context in its generator, so the transaction lasts
+    until the last chunk has been produced (or the client has gone away).
+    """
+    def __init__(self, database):
+        self.database = database
+        self.connection = None
+        self.began = False
+        self.memo = {}          # (sql, params, named) -> list of rows
+        self.executed = 0
+        self.reused = 0
+
+    def __enter__(self):
+        self.connection = get_connection(self.database)
+        # An in-memory copy (see use_memory_copy) never changes, so holding on to this
+        # connection is snapshot enough; a transaction would only add shared-cache locking.
+        # A context entered inside another one (same thread, same database) joins its transaction.
+        if self.database not in _memory_databases and not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+            self.began = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.began:
+            self.began = False
+            self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        logger.debug("query context db=%s executed=%d reused=%d", self.database, self.executed, self.reused)
+        self.memo.clear()
+
+    def iter_rows(self, query, params=(), named=True):
+        """Rows of query, lazily (see pyhtml.iter_rows); kept for a repeat once fully read."""
+        key = (query, tuple(params), named)
+        memo = self.memo.get(key)
+        if memo is not None:
+            self.reused += 1
+            yield from memo
+            return
+        self.executed += 1
+        kept = []
+        batches = iter_batches(self.database, query, params, named=named, connection=self.connection)
+        try:
+            for batch in batches:
+                if kept is not None:
+                    kept.extend(batch)
+                    if len(kept) > QUERY_MEMO_MAX_ROWS:
+                        kept = None
+                yield from batch
+        finally:
+            batches.close()
+        if kept is not None:
+            self.memo[key] = kept
+
+    def rows(self, query, params=(), named=True):
+        """All rows of query as a list."""
+        return list(self.iter_rows(query, params, named))
+
 def debugging_helper(message):
-    if (need_debugging_help):
-        print(message,)
+    """Kept for older page modules: logs message at DEBUG level (see configure_logging)."""
+    logger.debug("%s", message)
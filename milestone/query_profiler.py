@@ -0,0 +1,195 @@
+# query_profiler.py
+"""
+Profiling for every query that goes through pyhtml (get_results_from_query and
+the lazy iter_batches / iter_rows cursors).
+
+Queries are grouped by shape: the SQL with whitespace collapsed and literals
+replaced by '?', so the dynamically built filter variants of a page query each
+get one entry. For every shape we keep call count, total/max time and rows
+returned, and the first time a shape is seen its EXPLAIN QUERY PLAN is captured
+and checked for full table scans and temp B-trees. Queries slower than
+SLOW_QUERY_MS are logged to the "pyhtml.slow_query" logger.
+
+Register the module as a page to see the statistics (only served to localhost):
+    pyhtml.MyRequestHandler.pages["/diagnostics"] = query_profiler
+"""
+import functools
+import html
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+# Page attributes honoured by pyhtml.MyRequestHandler
+cacheable = False
+local_only = True
+
+ENABLED = True
+SLOW_QUERY_MS = 50      # queries at least this slow go to the slow-query log
+MAX_SHAPES = 500        # distinct shapes tracked; later ones are only counted in `untracked`
+RECENT_SLOW = 50        # slow queries kept for the diagnostics page
+
+slow_logger = logging.getLogger("pyhtml.slow_query")
+plan_logger = logging.getLogger("pyhtml.query_plan")
+
+# ---------- query shapes ----------
+_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    """Shape of sql: comments dropped, literals -> ?, IN lists -> (...), whitespace collapsed."""
+    shape = _COMMENT.sub(" ", sql)
+    shape = _STRING.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    shape = " ".join(shape.split())
+    shape = _IN_LIST.sub("(...)", shape)
+    return shape.rstrip(";").strip()
+
+# ---------- EXPLAIN QUERY PLAN ----------
+_FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+def explain(connection, sql, params=()):
+    """(plan lines, flags) for sql. Plan lines are indented by depth in the plan tree."""
+    depth = {0: -1}
+    lines, flags = [], []
+    subqueries = set()  # views and CTEs evaluated as co-routines: scanning those is not a table scan
+    for node, parent, _, detail in connection.execute("EXPLAIN QUERY PLAN " + sql, params):
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node] + detail)
+        if detail.startswith(("CO-ROUTINE ", "MATERIALIZE ")):
+            subqueries.add(detail.split(" ", 1)[1])
+        scan = _FULL_SCAN.match(detail)
+        if scan and scan.group(1) != "CONSTANT" and scan.group(1) not in subqueries:
+            flags.append(f"full scan of {scan.group(1)}")
+        elif detail.startswith("USE TEMP B-TREE"):
+            flags.append("temp b-tree " + detail[len("USE TEMP B-TREE "):].lower())
+    return lines, list(dict.fromkeys(flags))
+
+# ---------- statistics ----------
+class ShapeStats:
+    __slots__ = ("shape", "count", "total", "max", "rows", "plan", "flags")
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.plan = None    # list of plan lines once captured
+        self.flags = ()
+
+_lock = threading.Lock()
+shapes = {}             # shape -> ShapeStats
+recent_slow = deque(maxlen=RECENT_SLOW)  # (time, ms, rows, shape, params)
+untracked = 0
+
+def record(connection, database, sql, params, elapsed, rows):
+    """Account one executed query: elapsed seconds, rows returned."""
+    global untracked
+    if not ENABLED:
+        return
+    shape = normalize(sql)
+    with _lock:
+        stats = shapes.get(shape)
+        new = stats is None
+        if new:
+            if len(shapes) >= MAX_SHAPES:
+                untracked += 1
+                return
+            stats = shapes[shape] = ShapeStats(shape)
+        stats.count += 1
+        stats.total += elapsed
+        stats.rows += rows
+        if elapsed > stats.max:
+            stats.max = elapsed
+
+    elapsed_ms = elapsed * 1000
+    if elapsed_ms >= SLOW_QUERY_MS:
+        with _lock:
+            recent_slow.append((time.time(), elapsed_ms, rows, shape, params))
+        slow_logger.warning("slow query ms=%.1f rows=%d db=%s sql=%s params=%r",
+                            elapsed_ms, rows, database, shape, params)
+    if new:
+        # Only the thread that created the entry explains it, so each shape is explained once.
+        try:
+            stats.plan, flags = explain(connection, sql, params)
+        except Exception as e:  # a plan we cannot read must not fail the page
+            stats.plan, flags = [f"EXPLAIN failed: {e}"], []
+        stats.flags = tuple(flags)
+        if flags:
+            plan_logger.info("query plan flags=%s sql=%s", ", ".join(flags), shape)
+
+def snapshot():
+    """ShapeStats copies (as tuples) sorted by total time, plus the recent slow queries."""
+    with _lock:
+        rows = [(s.shape, s.count, s.total, s.max, s.rows, s.plan, s.flags) for s in shapes.values()]
+        slow = list(recent_slow)
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows, slow
+
+def reset():
+    global untracked
+    with _lock:
+        shapes.clear()
+        recent_slow.clear()
+        untracked = 0
+
+# ---------- diagnostics page ----------
+def get_page_html(form_data):
+    if "reset" in form_data:
+        reset()
+    rows, slow = snapshot()
+    esc = html.escape
+
+    shape_rows = []
+    for shape, count, total, max_s, nrows, plan, flags in rows:
+        plan_text = "\n".join(plan) if plan else "(pending)"
+        css = " class='flagged'" if flags else ""
+        shape_rows.append(
+            f"<tr{css}>"
+            f"<td class='num'>{count}</td>"
+            f"<td class='num'>{total * 1000:.1f}</td>"
+            f"<td class='num'>{total * 1000 / count:.2f}</td>"
+            f"<td class='num'>{max_s * 1000:.2f}</td>"
+            f"<td class='num'>{nrows / count:.1f}</td>"
+            f"<td>{esc(', '.join(flags)) or '—'}</td>"
+            f"<td><code>{esc(shape)}</code><pre>{esc(plan_text)}</pre></td></tr>")
+    slow_rows = [
+        f"<tr><td>{time.strftime('%H:%M:%S', time.localtime(at))}</td><td class='num'>{ms:.1f}</td>"
+        f"<td class='num'>{nrows}</td><td><code>{esc(shape)}</code></td><td><code>{esc(repr(params))}</code></td></tr>"
+        for at, ms, nrows, shape, params in reversed(slow)]
+
+    return f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>Query diagnostics</title>
+  <style>
+    body {{ font-family: Arial, sans-serif; margin: 20px; }}
+    table {{ border-collapse: collapse; width: 100%; margin-bottom: 24px; }}
+    th, td {{ border: 1px solid #ccc; padding: 4px 8px; text-align: left; vertical-align: top; font-size: 13px; }}
+    th {{ background: #f2f2f2; }}
+    td.num {{ text-align: right; white-space: nowrap; }}
+    tr.flagged td {{ background: #fff4e5; }}
+    pre {{ margin: 4px 0 0; color: #555; }}
+  </style>
+</head>
+<body>
+  <h1>Query diagnostics</h1>
+  <p>{len(rows)} query shapes; slow-query threshold {SLOW_QUERY_MS} ms;
+     {untracked} queries over the {MAX_SHAPES}-shape limit not tracked. <a href="?reset=1">Reset</a></p>
+  <h2>Query shapes by total time</h2>
+  <table>
+    <tr><th>Calls</th><th>Total ms</th><th>Mean ms</th><th>Max ms</th><th>Rows/call</th><th>Plan flags</th><th>Shape and plan</th></tr>
+    {''.join(shape_rows)}
+  </table>
+  <h2>Recent slow queries</h2>
+  <table>
+    <tr><th>Time</th><th>ms</th><th>Rows</th><th>Shape</th><th>Params</th></tr>
+    {''.join(slow_rows)}
+  </table>
+</body>
+</html>"""
@@ -0,0 +1,78 @@
+# refdata.py
+"""
+Reference data (the dimension tables) loaded once and shared by the pages.
+
+Antigens, regions and the years present in Vaccination change only when the
+database is rebuilt, yet the filter forms of Levels 2A and 3A need all three
+on every request. RefData keeps them in memory together with name -> ID
+lookups and the <option> lists pre-rendered for the unselected state:
+
+    ref = refdata.get_refdata(DB_PATH)
+    ref.antigen_options.render("Measles-containing vaccine, 1st dose")
+    ref.year_options.render(2004)        # ints and strings select the same option
+    ref.antigen_ids["Measles-containing vaccine, 1st dose"]   # -> "MCV1"
+
+Options.render() only splices ' selected="selected"' into the cached HTML; the
+markup is the same the pages used to build per request from three queries.
+
+Like coverage_store, the data is reloaded on first use after immunisation.db
+changes; call get_refdata() at startup to load it before the first request.
+"""
+
+import pyhtml
+
+ANTIGEN_SQL = "SELECT AntigenID, name FROM Antigen ORDER BY name;"
+REGION_SQL = "SELECT RegionID, region FROM Region ORDER BY region;"
+YEAR_SQL = "SELECT DISTINCT year FROM Vaccination ORDER BY year;"
+
+SELECTED = ' selected="selected"'
+
+class Options:
+    """<option> tags for a fixed [(value, label), ...] list, rendered once."""
+    __slots__ = ("html", "positions")
+    def __init__(self, options):
+        parts, self.positions, length = [], {}, 0
+        for val, label in options:
+            v = "" if val is None else str(val).strip()
+            head = f'<option value="{v}"'
+            # Values are unique here (names, region names, distinct years)
+            self.positions.setdefault(v, length + len(head))
+            part = f"{head}>{label}</option>"
+            parts.append(part)
+            length += len(part) + 1  # "\n" separator
+        self.html = "\n".join(parts)
+
+    def render(self, selected=None):
+        """The option list with `selected` (compared as a stripped string) marked selected."""
+        pos = None if selected is None else self.positions.get(str(selected).strip())
+        if pos is None:
+            return self.html
+        return self.html[:pos] + SELECTED + self.html[pos:]
+
+class RefData:
+    def __init__(self, antigens, regions, years):
+        # antigens / regions: [(id, name), ...] in name order; years: [year, ...] ascending
+        self.antigens = list(antigens)
+        self.regions = list(regions)
+        self.antigen_names = [name for _, name in antigens]
+        self.antigen_ids = {name: antigen_id for antigen_id, name in antigens}
+        self.region_names = [name for _, name in regions]
+        self.region_ids = {name: region_id for region_id, name in regions}
+        self.years = list(years)
+        self.year_set = frozenset(self.years)
+
+        # Dropdowns use readable VALUES (names), so filters are simple strings later
+        self.antigen_options = Options((name, name) for name in self.antigen_names)
+        self.region_options = Options((name, name) for name in self.region_names)
+        self.year_options = Options((year, year) for year in self.years)
+
+    @classmethod
+    def load(cls, db_path):
+        query = pyhtml.get_results_from_query
+        return cls(query(db_path, ANTIGEN_SQL), query(db_path, REGION_SQL),
+                   [row[0] for row in query(db_path, YEAR_SQL)])
+
+# ---------- shared instance, reloaded when the database changes ----------
+def get_refdata(db_path):
+    """The RefData for db_path (see pyhtml.versioned_singleton)."""
+    return pyhtml.versioned_singleton(db_path, RefData.load)
@@ -1,22 +1,21 @@
 # student_a_level_2.py
 import os
-import sqlite3
+import html
+import json
+from urllib.parse import urlencode
 import pyhtml
+import templates
+import refdata
+import cube
 
 # ---------- DB path (stable regardless of where the server is started) ----------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "database", "immunisation.db")
 
-# ---------- helpers ----------
-def exec_query(sql: str, params=()):
-    """Run a SELECT with placeholders and return list of tuples."""
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(sql, params)
-    rows = cur.fetchall()
-    con.close()
-    return rows
+# Rows per page in the "Countries meeting ≥90%" table
+PAGE_SIZE = 200
 
+# ---------- helpers ----------
 def get_first(form_data, key):
     """
     Return the first value for a query param (or None).
@@ -29,44 +28,46 @@ def get_first(form_data, key):
         return None
     return str(v)
 
-def options_html(options, selected_val):
+def rate_limited(form_data):
     """
-    Build <option> tags. options: [(value,label), ...]
-    Keeps selection even if types differ by normalizing to strings.
+    Unfiltered requests sort every row ≥90%: rendering them counts against the
+    client's rate limit (pyhtml.RATE_LIMIT). Cache hits are never limited.
     """
-    sel = "" if selected_val is None else str(selected_val).strip()
-    out = []
-    for val, label in options:
-        v = "" if val is None else str(val).strip()
-        s = ' selected="selected"' if v == sel else ""
-        out.append(f'<option value="{v}"{s}>{label}</option>')
-    return "\n".join(out)
+    return not any(get_first(form_data, k) for k in ("antigen", "year", "region"))
 
 def td_row(cells):
     return "<tr>" + "".join(f"<td>{'' if c is None else c}</td>" for c in cells) + "</tr>"
 
-# Coerce V.coverage to REAL, ignoring blanks
-PCT_EXPR = "CAST(NULLIF(TRIM(CAST(V.coverage AS TEXT)), '') AS REAL)"
+# Numeric coverage (blank -> NULL); a generated, indexed column added by migrate_db.py
+PCT_EXPR = "V.coverage_pct"
 
-# ---------- main ----------
-def get_page_html(form_data):
+def filter_sql(antigen, year, region):
+    """Optional WHERE conditions shared by both tables -> (sql, params)."""
+    sql, params = "", []
+    if antigen:
+        sql += " AND A.name = ?"
+        params.append(antigen.strip())
+    if year:
+        sql += " AND V.year = ?"
+        params.append(year.strip())
+    if region:
+        sql += " AND R.region = ?"
+        params.append(region.strip())
+    return sql, params
+
+def countries_query(antigen=None, year=None, region=None, after=None, limit=None):
     """
-    Level 2A:
-      - Filters: antigen (name), year, region (name, optional)
-      - Table 1: Countries meeting ≥90% target
-      - Table 2: Per-region count meeting ≥90%
+    Table 1: countries meeting the ≥90% target -> (sql, params).
+    after = (percentage, country, antigen, year) of the last row already shown:
+    keyset pagination resumes right after it in the ORDER BY below.
     """
-    antigen = get_first(form_data, "antigen")   # antigen name, e.g., "Measles-containing vaccine, 1st dose"
-    year    = get_first(form_data, "year")      # e.g., "2004"
-    region  = get_first(form_data, "region")    # region name, e.g., "South Asia"
-
-    # Dropdowns use readable VALUES (names), so filters are simple strings later
-    antigen_opts = exec_query("SELECT name, name FROM Antigen ORDER BY name;")
-    year_opts    = [(y[0], y[0]) for y in exec_query("SELECT DISTINCT year FROM Vaccination ORDER BY year;")]
-    region_opts  = exec_query("SELECT region, region FROM Region ORDER BY region;")
-
-    # ---------- Table 1: Countries meeting ≥90% ----------
-    sql1 = f"""
+    where, params = filter_sql(antigen, year, region)
+    if after is not None:
+        where += f"""
+        AND (ROUND({PCT_EXPR}, 1) < ?
+             OR (ROUND({PCT_EXPR}, 1) = ? AND (C.name, A.name, V.year) > (?, ?, ?)))"""
+        params += [after[0], after[0], after[1], after[2], after[3]]
+    sql = f"""
       SELECT
         A.name AS antigen,
         V.year AS year,
@@ -77,120 +78,93 @@ def get_page_html(form_data):
       JOIN Antigen  A ON A.AntigenID  = V.antigen
       JOIN Country  C ON C.CountryID  = V.country
       LEFT JOIN Region  R ON R.RegionID = C.region
-      WHERE {PCT_EXPR} IS NOT NULL AND {PCT_EXPR} >= 90
+      WHERE {PCT_EXPR} >= 90{where}
+      ORDER BY percentage_of_target DESC, country, antigen, year
     """
-    p1 = []
-    if antigen:
-        sql1 += " AND A.name = ?"
-        p1.append(antigen.strip())
-    if year:
-        sql1 += " AND V.year = ?"
-        p1.append(year.strip())
-    if region:
-        sql1 += " AND R.region = ?"
-        p1.append(region.strip())
-    sql1 += " ORDER BY percentage_of_target DESC, country;"
-    rows1 = exec_query(sql1, tuple(p1))
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, tuple(params)
 
-    # ---------- Table 2: Per-region counts meeting ≥90% ----------
-    sql2 = f"""
-      SELECT
-        A.name   AS antigen,
-        V.year   AS year,
-        R.region AS region,
-        COUNT(DISTINCT C.CountryID) AS countries_met_90
-      FROM Vaccination V
-      JOIN Antigen  A ON A.AntigenID  = V.antigen
-      JOIN Country  C ON C.CountryID  = V.country
-      LEFT JOIN Region  R ON R.RegionID = C.region
-      WHERE {PCT_EXPR} IS NOT NULL AND {PCT_EXPR} >= 90
+def region_counts(antigen=None, year=None, region=None):
+    """
+    Table 2: per-region count of countries meeting ≥90%, read from the cube
+    -> [(antigen, year, region, countries_met_90), ...], most countries first.
+    Same rows as GROUP BY antigen, year, region over Table 1's rows.
     """
-    p2 = []
+    ref = refdata.get_refdata(DB_PATH)
+    data = cube.get_cube(DB_PATH)
+    fixed = {"economy": cube.ALL}
+    # Filters are names (as in the dropdowns); an unknown one matches nothing, as in SQL
     if antigen:
-        sql2 += " AND A.name = ?"
-        p2.append(antigen.strip())
+        fixed["antigen"] = ref.antigen_ids.get(antigen.strip())
     if year:
-        sql2 += " AND V.year = ?"
-        p2.append(year.strip())
+        year = year.strip()
+        fixed["year"] = int(year) if year.isdigit() else None
     if region:
-        sql2 += " AND R.region = ?"
-        p2.append(region.strip())
-    sql2 += """
-      GROUP BY A.name, V.year, R.region
-      ORDER BY countries_met_90 DESC, R.region;
-    """
-    rows2 = exec_query(sql2, tuple(p2))
+        fixed["region"] = ref.region_ids.get(region.strip())
+    if None in fixed.values():
+        return []
+    names = data.labels
+    rows = [(names["antigen"][a], y, names["region"].get(r), cell.met[90])
+            for (a, y, r, _), cell in data.group(("antigen", "year", "region"), **fixed) if cell.met[90]]
+    # SQL's order: NULL region first
+    rows.sort(key=lambda r: (-r[3], r[2] is not None, r[2] or "", r[0], r[1]))
+    return rows
+
+def get_after(form_data):
+    """Decode the keyset 'after' param ([percentage, country, antigen, year]) or None."""
+    raw = get_first(form_data, "after")
+    try:
+        after = json.loads(raw) if raw else None
+    except ValueError:
+        return None
+    if not (isinstance(after, list) and len(after) == 4 and isinstance(after[0], (int, float))
+            and isinstance(after[1], str) and isinstance(after[2], str) and isinstance(after[3], int)):
+        return None
+    # Out-of-range numbers would not fit an SQLite parameter: no cursor, not a failed query
+    try:
+        percentage = float(after[0])
+    except OverflowError:
+        return None
+    if not 0 <= after[3] < 10000:
+        return None
+    return (percentage, after[1], after[2], after[3])
 
-    # ---------- HTML ----------
-    page_html = f"""<!DOCTYPE html>
+def page_link(antigen, year, region, after=None):
+    params = {k: v for k, v in (("antigen", antigen), ("year", year), ("region", region)) if v}
+    if after is not None:
+        params["after"] = json.dumps(list(after), ensure_ascii=False)
+    return html.escape("/page2?" + urlencode(params))
+
+# ---------- page template (compiled once at import) ----------
+PAGE = templates.Template("""<!DOCTYPE html>
 <html lang="en">
 <head>
   <meta charset="utf-8">
   <title>Level 2A — Vaccination Rates</title>
-  <style>
-    body {{
-      font-family: "Segoe UI", Roboto, Arial, sans-serif;
-      margin: 0;
-      background: linear-gradient(135deg, #bbf7d0 0%, #f0fdf4 100%);
-      color: #064e3b;
-      min-height: 100vh;
-    }}
-    header {{
-      text-align: center; padding: 40px 20px 20px;
-      background: linear-gradient(90deg, #22c55e, #16a34a); color: white;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.15);
-    }}
-    header h1 {{ margin: 0; font-size: 2rem; letter-spacing: .5px; }}
-
-    .filters {{
-      display: flex; gap: 12px; align-items: center; flex-wrap: wrap; justify-content: center;
-      background: #dcfce7; padding: 16px; border-radius: 12px; margin: 20px auto; width: fit-content;
-      box-shadow: 0 3px 8px rgba(0,0,0,0.1);
-    }}
-    select, button {{
-      padding: 8px 12px; border: 1px solid #86efac; border-radius: 8px; background: white; color: #065f46;
-    }}
-    button {{ background: #22c55e; color: white; cursor: pointer; border: none; }}
-    button:hover {{ background: #15803d; }}
-
-    table {{
-      border-collapse: collapse; width: 90%; margin: 20px auto; background: white;
-      border-radius: 12px; overflow: hidden; box-shadow: 0 4px 10px rgba(0,0,0,0.08);
-    }}
-    th, td {{ border: 1px solid #e5e7eb; padding: 10px 14px; text-align: left; }}
-    th {{ background: #bbf7d0; color: #064e3b; }}
-    tr:nth-child(even) {{ background: #f9fafb; }}
-
-    h3 {{ text-align: center; color: #166534; margin-top: 30px; }}
-
-    .footer {{ text-align: center; margin: 30px 0; }}
-    .footer a {{
-      background: #bbf7d0; color: #065f46; padding: 8px 14px; border-radius: 8px; transition: .2s; margin: 0 5px;
-      text-decoration: none;
-    }}
-    .footer a:hover {{ background: #22c55e; color: white; }}
-  </style>
+  <link rel="stylesheet" href="{{stylesheet}}">
 </head>
-<body>
+<body class="theme-green level2">
   <header><h1>💉 Vaccination Coverage by Country & Region</h1></header>
 
   <form action="/page2" method="GET" class="filters">
     <label>Antigen
       <select name="antigen">
         <option value="">All</option>
-        {options_html(antigen_opts, antigen)}
+        {{antigen_options}}
       </select>
     </label>
     <label>Year
       <select name="year">
         <option value="">All</option>
-        {options_html(year_opts, year)}
+        {{year_options}}
       </select>
     </label>
     <label>Region
       <select name="region">
         <option value="">All regions</option>
-        {options_html(region_opts, region)}
+        {{region_options}}
       </select>
     </label>
     <button type="submit">Apply</button>
@@ -203,9 +177,10 @@ def get_page_html(form_data):
       <tr><th>Antigen</th><th>Year</th><th>Country</th><th>Region</th><th>% of Target</th></tr>
     </thead>
     <tbody>
-      { ( "".join( td_row(r) for r in rows1 ) ) or "<tr><td colspan='5'>No data</td></tr>" }
+      {{country_rows}}
     </tbody>
   </table>
+  <div class="pager">{{pager}}</div>
 
   <h3>🗺️ Regional Counts Meeting ≥90%</h3>
   <table>
@@ -213,7 +188,7 @@ def get_page_html(form_data):
       <tr><th>Antigen</th><th>Year</th><th>Region</th><th>Countries ≥90%</th></tr>
     </thead>
     <tbody>
-      { ( "".join( td_row(r) for r in rows2 ) ) or "<tr><td colspan='4'>No data</td></tr>" }
+      {{region_rows}}
     </tbody>
   </table>
 
@@ -222,5 +197,73 @@ def get_page_html(form_data):
     <a href="/page3">→ Go to Level 3A</a>
   </div>
 </body>
-</html>"""
-    return page_html
+</html>""")
+
+# ---------- main ----------
+def get_page_html(form_data):
+    """
+    Level 2A:
+      - Filters: antigen (name), year, region (name, optional)
+      - Table 1: Countries meeting ≥90% target (PAGE_SIZE rows per page)
+      - Table 2: Per-region count meeting ≥90%
+    Returns a generator of HTML chunks, so Table 1 streams as rows come off the cursor.
+    Table 2 is a lookup in the cube (see cube.py), not a query.
+    """
+    antigen = get_first(form_data, "antigen")   # antigen name, e.g., "Measles-containing vaccine, 1st dose"
+    year    = get_first(form_data, "year")      # e.g., "2004"
+    region  = get_first(form_data, "region")    # region name, e.g., "South Asia"
+    after   = get_after(form_data)              # keyset of the previous page's last row
+
+    # Dropdowns (antigen, year and region names) come pre-rendered from refdata.
+    # Like Table 2's cube, it is resolved before the read transaction below begins:
+    # loaded inside it, it would come from that snapshot, not the current database.
+    ref = refdata.get_refdata(DB_PATH)
+    rows2 = region_counts(antigen, year, region)
+
+    # All of this request's queries share one connection and one read transaction
+    q = pyhtml.QueryContext(DB_PATH)
+
+    # ---------- Table 1: Countries meeting ≥90% (one page, streamed) ----------
+    table1 = {"shown": 0, "last": None, "more": False}
+
+    def country_rows():
+        # One row past the page tells whether there is a next page
+        for r in q.iter_rows(*countries_query(antigen, year, region, after, PAGE_SIZE + 1)):
+            if table1["shown"] == PAGE_SIZE:
+                table1["more"] = True
+                break
+            table1["shown"] += 1
+            table1["last"] = r
+            yield td_row(r)
+        if not table1["shown"]:
+            yield "<tr><td colspan='5'>No data</td></tr>"
+
+    def pager():
+        # Called once Table 1 has been streamed, so its last row is known
+        links = []
+        if after is not None:
+            links.append(f'<a href="{page_link(antigen, year, region)}">⏮ First page</a>')
+        if table1["more"]:
+            # keyset = (percentage, country, antigen, year) of the last row shown
+            last = table1["last"]
+            next_after = (last.percentage_of_target, last.country, last.antigen, last.year)
+            links.append(f'<a href="{page_link(antigen, year, region, next_after)}">Next {PAGE_SIZE} →</a>')
+        return " ".join(links)
+
+    # ---------- Table 2: Per-region counts meeting ≥90% (from the pre-aggregated cube) ----------
+    def region_rows():
+        return "".join(td_row(r) for r in rows2) or "<tr><td colspan='4'>No data</td></tr>"
+
+    def page():
+        with q:
+            yield from PAGE.stream(
+                stylesheet=templates.static_url("css/site.css"),
+                antigen_options=ref.antigen_options.render(antigen),
+                year_options=ref.year_options.render(year),
+                region_options=ref.region_options.render(region),
+                country_rows=country_rows(),
+                pager=pager,
+                region_rows=region_rows,
+            )
+
+    return page()
@@ -1,20 +1,28 @@
 # student_a_level_3.py
 import os
+import html
+import json
 import sqlite3
+from urllib.parse import urlencode
 import pyhtml
+import templates
+import coverage_store
+import refdata
 
 # --- Absolute path to database ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "database", "immunisation.db")
 
+# Rank improvements with the in-memory coverage_store; SQLite is the fallback.
+USE_COVERAGE_STORE = True
+
+# Rendering this page counts against each client's rate limit (pyhtml.RATE_LIMIT); cache hits do not.
+rate_limited = True
+
 # ------------------------- helpers -------------------------
-def exec_query(sql: str, params=()):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(sql, params)
-    rows = cur.fetchall()
-    con.close()
-    return rows
+def iter_query(sql: str, params=()):
+    # Runs on pyhtml's pooled per-thread connection; rows are fetched lazily, in batches
+    return pyhtml.iter_rows(DB_PATH, sql, params)
 
 def get_first(form_data, key, cast=None):
     """
@@ -33,162 +41,101 @@ def get_first(form_data, key, cast=None):
             return None
     return v
 
-def options_html(options, selected_val):
-    """
-    Render <option> for <select>. options: [(value,label),...]
-    Handles type differences (int/str) safely.
-    """
-    sel = "" if selected_val is None else str(selected_val).strip()
-    out = []
-    for val, label in options:
-        v_str = "" if val is None else str(val).strip()
-        s = ' selected="selected"' if v_str == sel else ""
-        out.append(f'<option value="{v_str}"{s}>{label}</option>')
-    return "\n".join(out)
-
 def td_row(cells):
     return "<tr>" + "".join(f"<td>{'' if c is None else c}</td>" for c in cells) + "</tr>"
 
-# Safely coerce coverage text->REAL and ignore blanks
-COVER_REAL = "CAST(NULLIF(TRIM(CAST(coverage AS TEXT)), '') AS REAL)"
+# Numeric coverage (blank -> NULL); a generated, indexed column added by migrate_db.py
+COVER_REAL = "coverage_pct"
 
-# ------------------------- main page -------------------------
-def get_page_html(form_data):
+def improvement_query(start_year, end_year, antigen_name=None, limit=10, after=None):
     """
-    Level 3A — Improvement in vaccination coverage:
-      Inputs:
-        - antigen (by name)
-        - start_year
-        - end_year
-        - top_n (how many countries to list)
-      Output:
-        - Table of countries with largest (end - start) coverage increase
+    Countries with the largest (end - start) coverage increase -> (sql, params).
+    after = (rate_increase, country, antigen) of the last row already shown (keyset pagination).
+    """
+    # Join same country+antigen across the two chosen years, compute end−start
+    sql = f"""
+        SELECT
+            C.name AS country,
+            A.name AS antigen,
+            ROUND(V2.{COVER_REAL} - V1.{COVER_REAL}, 2) AS rate_increase,
+            V1.year AS start_year,
+            V2.year AS end_year
+        FROM Vaccination V1
+        JOIN Vaccination V2
+          ON V1.country = V2.country
+         AND V1.antigen = V2.antigen
+        JOIN Country  C ON C.CountryID  = V1.country
+        JOIN Antigen  A ON A.AntigenID  = V1.antigen
+        WHERE V1.year = ?
+          AND V2.year = ?
+          AND V1.{COVER_REAL} IS NOT NULL
+          AND V2.{COVER_REAL} IS NOT NULL
     """
+    params = [start_year, end_year]
 
-    # --- read filters ---
-    antigen_name = get_first(form_data, "antigen")     # e.g. "DTP-containing vaccine, 3rd dose"
-    start_year   = get_first(form_data, "start_year", int)
-    end_year     = get_first(form_data, "end_year", int)
-    top_n        = get_first(form_data, "top_n", int)
+    # Optional antigen filter by name (matches Antigen.name)
+    if antigen_name:
+        sql += " AND A.name = ?"
+        params.append(antigen_name.strip())
 
-    # defaults (so the page shows something on first load)
-    if top_n is None:      top_n = 10
+    if after is not None:
+        rate = f"ROUND(V2.{COVER_REAL} - V1.{COVER_REAL}, 2)"
+        sql += f" AND ({rate} < ? OR ({rate} = ? AND (C.name, A.name) > (?, ?)))"
+        params += [after[0], after[0], after[1], after[2]]
 
-    # dropdown sources
-    antigen_opts = exec_query("SELECT name, name FROM Antigen ORDER BY name;")  # value=label=name
-    year_vals    = [y[0] for y in exec_query("SELECT DISTINCT year FROM Vaccination ORDER BY year;")]
-    year_opts    = [(y, y) for y in year_vals]
+    # country/antigen break ties so the ranking does not depend on the query plan
+    sql += """
+        ORDER BY rate_increase DESC, country, antigen
+        LIMIT ?
+    """
+    params.append(limit)
+    return sql, tuple(params)
 
-    # If no years chosen yet, pick a sensible default range
-    if start_year is None and year_vals:
-        start_year = year_vals[0]
-    if end_year is None and year_vals:
-        end_year = year_vals[-1]
+def top_improvements(start_year, end_year, antigen_name=None, limit=10, after=None):
+    """Largest coverage increases, from the coverage store or (fallback) SQLite."""
+    if USE_COVERAGE_STORE:
+        try:
+            store = coverage_store.get_store(DB_PATH)
+        except sqlite3.Error as e:
+            pyhtml.logger.warning("coverage_store unavailable, using SQLite: %s", e)
+        else:
+            return store.top_improvements(start_year, end_year, antigen_name, limit, after)
+    return list(iter_query(*improvement_query(start_year, end_year, antigen_name, limit, after)))
 
-    rows = []
-    warning = None
+def get_after(form_data):
+    """Decode the keyset 'after' param ([rate_increase, country, antigen]) or None."""
+    raw = get_first(form_data, "after")
+    try:
+        after = json.loads(raw) if raw else None
+    except ValueError:
+        return None
+    if not (isinstance(after, list) and len(after) == 3 and isinstance(after[0], (int, float))
+            and isinstance(after[1], str) and isinstance(after[2], str)):
+        return None
+    # A huge int would not fit an SQLite parameter: no cursor, not a failed query
+    try:
+        return (float(after[0]), after[1], after[2])
+    except OverflowError:
+        return None
 
-    # Only run when we have both years and a valid order (start <= end)
-    if start_year is not None and end_year is not None and start_year <= end_year:
-        # Build query: join same country+antigen across the two chosen years, compute end−start
-        sql = f"""
-            SELECT
-                C.name AS country,
-                A.name AS antigen,
-                ROUND(
-                    (CAST(NULLIF(TRIM(CAST(V2.coverage AS TEXT)), '') AS REAL)
-                   -CAST(NULLIF(TRIM(CAST(V1.coverage AS TEXT)), '') AS REAL)
-                    ), 2
-                ) AS rate_increase,
-                V1.year AS start_year,
-                V2.year AS end_year
-            FROM Vaccination V1
-            JOIN Vaccination V2
-              ON V1.country = V2.country
-             AND V1.antigen = V2.antigen
-            JOIN Country  C ON C.CountryID  = V1.country
-            JOIN Antigen  A ON A.AntigenID  = V1.antigen
-            WHERE V1.year = ?
-              AND V2.year = ?
-              AND {COVER_REAL.replace("coverage", "V1.coverage")} IS NOT NULL
-              AND {COVER_REAL.replace("coverage", "V2.coverage")} IS NOT NULL
-        """
-        params = [start_year, end_year]
-
-        # Optional antigen filter by name (matches Antigen.name)
-        if antigen_name:
-            sql += " AND A.name = ?"
-            params.append(antigen_name.strip())
-
-        sql += """
-            ORDER BY rate_increase DESC
-            LIMIT ?
-        """
-        params.append(top_n if isinstance(top_n, int) and top_n > 0 else 10)
-
-        rows = exec_query(sql, tuple(params))
-    else:
-        warning = "Please choose a valid start and end year (start ≤ end)."
+def page_link(antigen_name, start_year, end_year, top_n, after=None):
+    params = {"start_year": start_year, "end_year": end_year, "top_n": top_n}
+    if antigen_name:
+        params["antigen"] = antigen_name
+    if after is not None:
+        params["after"] = json.dumps(list(after), ensure_ascii=False)
+    return html.escape("/page3?" + urlencode(params))
 
-    # ------------------------- HTML -------------------------
-    page_html = f"""<!DOCTYPE html>
+# ------------------------- page template -------------------------
+# Compiled once at import; only the placeholders are rendered per request.
+PAGE = templates.Template("""<!DOCTYPE html>
 <html lang="en">
 <head>
   <meta charset="utf-8">
   <title>Level 3A — Improvement Analysis</title>
-  <style>
-    body {{
-      font-family: "Segoe UI", Roboto, Arial, sans-serif;
-      margin: 0;
-      background: linear-gradient(135deg, #cffafe 0%, #ecfeff 100%);
-      color: #0e7490;
-      min-height: 100vh;
-    }}
-    header {{
-      text-align: center;
-      padding: 40px 20px 20px;
-      background: linear-gradient(90deg, #06b6d4, #0891b2);
-      color: white;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.15);
-    }}
-    header h1 {{ margin: 0; font-size: 2rem; letter-spacing: .5px; }}
-
-    .filters {{
-      display: flex; gap: 12px; align-items: end; flex-wrap: wrap; justify-content: center;
-      background: #e0f2fe; padding: 16px; border-radius: 12px; margin: 20px auto; width: fit-content;
-      box-shadow: 0 3px 8px rgba(0,0,0,0.08);
-    }}
-    .filters label {{ display: grid; gap: 4px; font-size: .95rem; color: #075985; }}
-    select, input[type="number"], button {{
-      padding: 8px 12px; border: 1px solid #7dd3fc; border-radius: 8px; background: white; color: #075985;
-    }}
-    input[type="number"] {{ width: 90px; }}
-    button {{ background: #06b6d4; color: white; cursor: pointer; border: none; }}
-    button:hover {{ background: #0ea5e9; }}
-    a {{ text-decoration: none; color: #0ea5e9; font-weight: 500; }}
-    a:hover {{ text-decoration: underline; }}
-
-    .warn {{
-      max-width: 900px; margin: 0 auto; color: #b45309; background: #fffbeb; border: 1px solid #fcd34d;
-      padding: 10px 14px; border-radius: 8px; box-shadow: 0 2px 6px rgba(0,0,0,0.06);
-    }}
-
-    table {{
-      border-collapse: collapse; width: 90%; margin: 20px auto; background: white;
-      border-radius: 12px; overflow: hidden; box-shadow: 0 4px 10px rgba(0,0,0,0.08);
-    }}
-    th, td {{ border: 1px solid #e5e7eb; padding: 10px 14px; text-align: left; }}
-    th {{ background: #bae6fd; color: #075985; }}
-    tr:nth-child(even) {{ background: #f9fafb; }}
-
-    .footer {{ text-align: center; margin: 30px 0; }}
-    .footer a {{
-      background: #bae6fd; color: #075985; padding: 8px 14px; border-radius: 8px; transition: .2s; margin: 0 5px;
-    }}
-    .footer a:hover {{ background: #06b6d4; color: white; }}
-  </style>
+  <link rel="stylesheet" href="{{stylesheet}}">
 </head>
-<body>
+<body class="theme-cyan level3">
   <header>
     <h1>📈 Level 3A — Biggest Improvements in Vaccination Coverage</h1>
   </header>
@@ -197,31 +144,31 @@ def get_page_html(form_data):
     <label>Antigen
       <select name="antigen">
         <option value="">All antigens</option>
-        {options_html(antigen_opts, antigen_name)}
+        {{antigen_options}}
       </select>
     </label>
 
     <label>Start year
       <select name="start_year">
-        {options_html(year_opts, start_year)}
+        {{start_year_options}}
       </select>
     </label>
 
     <label>End year
       <select name="end_year">
-        {options_html(year_opts, end_year)}
+        {{end_year_options}}
       </select>
     </label>
 
     <label>Top N
-      <input type="number" name="top_n" min="1" max="100" value="{top_n or 10}">
+      <input type="number" name="top_n" min="1" max="100" value="{{top_n}}">
     </label>
 
     <button type="submit">Apply</button>
     <a href="/page3">Reset</a>
   </form>
 
-  {"<div class='warn'>"+warning+"</div>" if warning else ""}
+  {{warning}}
 
   <table>
     <thead>
@@ -234,14 +181,78 @@ def get_page_html(form_data):
       </tr>
     </thead>
     <tbody>
-      { ( "".join( td_row(r) for r in rows ) ) or "<tr><td colspan='5'>No data</td></tr>" }
+      {{rows}}
     </tbody>
   </table>
+  <div class="pager">{{pager}}</div>
 
   <div class="footer">
     <a href="/">← Back to Level 1A</a>
     <a href="/page2">← Back to Level 2A</a>
   </div>
 </body>
-</html>"""
-    return page_html
+</html>""")
+
+# ------------------------- main page -------------------------
+def get_page_html(form_data):
+    """
+    Level 3A — Improvement in vaccination coverage:
+      Inputs:
+        - antigen (by name)
+        - start_year
+        - end_year
+        - top_n (how many countries to list per page)
+        - after (keyset of the previous page's last row, set by the "Next" link)
+      Output:
+        - Table of countries with largest (end - start) coverage increase
+    """
+
+    # --- read filters ---
+    antigen_name = get_first(form_data, "antigen")     # e.g. "DTP-containing vaccine, 3rd dose"
+    start_year   = get_first(form_data, "start_year", int)
+    end_year     = get_first(form_data, "end_year", int)
+    top_n        = get_first(form_data, "top_n", int)
+    after        = get_after(form_data)
+
+    # defaults (so the page shows something on first load)
+    if top_n is None:      top_n = 10
+
+    # dropdown sources (loaded once, see refdata.py)
+    ref = refdata.get_refdata(DB_PATH)
+    year_vals = ref.years
+
+    # If no years chosen yet, pick a sensible default range
+    if start_year is None and year_vals:
+        start_year = year_vals[0]
+    if end_year is None and year_vals:
+        end_year = year_vals[-1]
+
+    rows = []
+    warning = None
+    pager = []
+
+    # Only run when we have both years and a valid order (start <= end)
+    if start_year is not None and end_year is not None and start_year <= end_year:
+        limit = top_n if isinstance(top_n, int) and top_n > 0 else 10
+        # One extra row tells us whether there is a next page
+        rows = top_improvements(start_year, end_year, antigen_name, limit + 1, after)
+        if after is not None:
+            pager.append(f'<a href="{page_link(antigen_name, start_year, end_year, limit)}">⏮ First page</a>')
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after = (rows[-1][2], rows[-1][0], rows[-1][1])
+            pager.append(f'<a href="{page_link(antigen_name, start_year, end_year, limit, next_after)}">Next {limit} →</a>')
+    else:
+        warning = "Please choose a valid start and end year (start ≤ end)."
+
+    # ------------------------- HTML -------------------------
+    return PAGE.render(
+        stylesheet=templates.static_url("css/site.css"),
+        antigen_options=ref.antigen_options.render(antigen_name),
+        start_year_options=ref.year_options.render(start_year),
+        end_year_options=ref.year_options.render(end_year),
+        top_n=top_n or 10,
+        warning="<div class='warn'>"+warning+"</div>" if warning else "",
+        rows=( "".join( td_row(r) for r in rows ) ) or "<tr><td colspan='5'>No data</td></tr>",
+        pager=" ".join(pager),
+    )
@@ -0,0 +1,73 @@
+# templates.py
+"""
+Page templates compiled once, at import time.
+
+A template is HTML with {{name}} placeholders. Compiling splits it into
+static fragments, kept as UTF-8 bytes, and the names between them, so a
+request only encodes the dynamic parts (dropdowns, table rows):
+
+    PAGE = templates.Template("<h1>{{title}}</h1><table>{{rows}}</table>")
+    PAGE.render(title="Overview", rows=rows_html)      -> bytes
+    PAGE.stream(title="Overview", rows=row_generator)  -> generator of bytes
+
+A value may be str, bytes, None (renders nothing), an iterable of values
+(streamed piece by piece), or a callable returning a value, which is only
+called when its placeholder is reached, i.e. after everything before it has
+been produced. Values are inserted as they are: escape user input yourself.
+
+static_url() gives links to files served by pyhtml (CSS, images) a content
+hash, so they can be cached by browsers for a long time.
+"""
+import hashlib
+import os
+import re
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_FIELD = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+class Template:
+    __slots__ = ("static", "fields")
+    def __init__(self, source):
+        parts = _FIELD.split(source)
+        self.static = [part.encode("utf-8") for part in parts[0::2]]
+        self.fields = parts[1::2]
+
+    def stream(self, **values):
+        """Yield the page as bytes chunks, static fragments included."""
+        static = self.static
+        for i, name in enumerate(self.fields):
+            if static[i]:
+                yield static[i]
+            yield from _encode(values[name])
+        if static[-1]:
+            yield static[-1]
+
+    def render(self, **values):
+        return b"".join(self.stream(**values))
+
+def _encode(value):
+    if value is None:
+        return
+    if callable(value):
+        value = value()
+    if isinstance(value, bytes):
+        yield value
+    elif isinstance(value, str):
+        yield value.encode("utf-8")
+    elif isinstance(value, (int, float)):
+        yield str(value).encode("utf-8")
+    else:
+        for item in value:
+            yield from _encode(item)
+
+_static_urls = {}
+
+def static_url(path):
+    """'/path?v=<hash>' for a file under the milestone folder; the hash changes with its content."""
+    url = _static_urls.get(path)
+    if url is None:
+        with open(os.path.join(BASE_DIR, path), "rb") as f:
+            digest = hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+        url = _static_urls[path] = f"/{path}?v={digest}"
+    return url